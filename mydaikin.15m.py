@@ -17,41 +17,138 @@
 # Run xbar
 
 
-try:   # Python 3 dependencies
-    from urllib.parse import urlencode
-    from urllib.request import Request, urlopen, build_opener
-    from urllib.request import ProxyHandler, HTTPBasicAuthHandler, HTTPHandler, HTTPError, URLError
-except: # Python 2 dependencies
-    from urllib import urlencode
-    from urllib2 import Request, urlopen, build_opener
-    from urllib2 import ProxyHandler, HTTPBasicAuthHandler, HTTPHandler, HTTPError, URLError
-
-import ast
+import time
+
+# Startup cost of every phase, reported by --startup
+STARTUP_CPU = time.process_time()
+STARTUP_TIMES = [('start', time.perf_counter())]
+
+# Only modules needed by every entry path are imported here, the others where they
+# are used: urllib3 for requests to units, asyncio for discovery, socketserver for
+# the daemon and logging for debug messages, so that commands and menus served by
+# the daemon start faster
 import json
 import sys
-import datetime
-import calendar
-import base64
-import math
-import time
 import os
-import subprocess
 import socket
-import socketserver
+import contextlib
+import struct
+import fcntl
 import threading
-import logging
-import urllib3
-import logging
-import urllib
 
 from collections import OrderedDict
 
-
-# Wait till you have discovered at least X units
-MY_NUMBER_UNITS=4
-
-
-from datetime import date
+STARTUP_TIMES.append(('imports', time.perf_counter()))
+
+
+# Stop discovery once X units were discovered, or with None once all units answered. When
+# the cached units expired, discovery stops as soon as all of them answered again
+MY_NUMBER_UNITS=None
+
+# Stop discovery once no unit responded for X seconds
+MY_DISCOVERY_QUIET=1.0
+
+# Networks where broadcasts are filtered, e.g. ['10.1.0.0/24', '10.2.0.0/23'], are swept
+# with unicast probes, at most X probes per second
+MY_DISCOVERY_SUBNETS=[]
+MY_DISCOVERY_SWEEP_RATE=1000
+
+# Give up on polling units after X seconds per refresh, and on a single unit request after Y
+# seconds per attempt, so that a request and its retries end within X seconds
+MY_REFRESH_DEADLINE=10
+MY_UNIT_TIMEOUT=3
+
+# Poll at most X units at the same time
+MY_POLL_WORKERS=16
+
+# HTTP connections are shared and kept alive across units and polls. Daikin adapters
+# only cope with one or two sockets, so keep at most X connections open per unit
+MY_HTTP_CONNECT_TIMEOUT=2
+MY_HTTP_READ_TIMEOUT=4
+MY_HTTP_RETRIES=2
+MY_HTTP_BACKOFF=0.2
+MY_HTTP_MAXSIZE=1
+MY_HTTP_POOLS=64
+
+# Reuse the control state of a unit for X seconds after it was last read or set
+MY_CONTROL_CACHE_TTL=60
+
+# Poll every endpoint of a unit on its own schedule: basic info (name, MAC, firmware)
+# every X seconds, and along with any other endpoint so that the MAC of every unit that
+# is requested is checked, and control info every Y seconds, unless changed by a command. Sensor
+# info every Z seconds while a unit is on and more than D degrees from its target, less
+# often once it reached its target or is switched off. Endpoints due within S seconds
+# are polled right away, so that they do not wait for the next refresh
+MY_POLL_BASIC_INFO=24*3600
+MY_POLL_CONTROL_INFO=10*60
+MY_POLL_SENSOR_ACTIVE=2*60
+MY_POLL_SENSOR_STABLE=10*60
+MY_POLL_SENSOR_OFF=30*60
+MY_POLL_SENSOR_DELTA=0.5
+MY_POLL_SLACK=60
+
+# Send a click right away, and coalesce the clicks on the same unit that follow while it
+# is written or less than X seconds after into a single write, sent once X seconds passed
+# since the previous write. Set to 0 to send every click on its own
+MY_COMMAND_DEBOUNCE=0.5
+
+# Scenes in the menu, applied to all units at once: name -> control fields to set
+MY_SCENES=OrderedDict([('Heat 21°C, fan auto', {'pow': '1', 'mode': '4', 'stemp': '21.0', 'f_rate': 'A'}),
+                       ('Cool 24°C, fan auto', {'pow': '1', 'mode': '3', 'stemp': '24.0', 'f_rate': 'A'}),
+                       ('All off', {'pow': '0'})])
+
+# Setpoint range per mode of auto, cooling and heating, which the adapters do not report.
+# The temperature menu of a unit offers X setpoints around its current one, within the
+# range of its current mode in steps of Y degrees
+MY_SETPOINT_RANGES=OrderedDict([('0', (18.0, 30.0)), ('3', (18.0, 32.0)), ('4', (10.0, 30.0))])
+MY_SETPOINT_CHOICES=8
+MY_SETPOINT_STEP=1.0
+
+# Skip a unit after X consecutive failed polls, for Y seconds doubling with every further
+# failure up to Z seconds. Meanwhile a skipped unit is probed in the background with a TCP
+# connect that gives up after P seconds, and polled again by the refresh after it accepted
+MY_BREAKER_FAILURES=2
+MY_BREAKER_BACKOFF=60
+MY_BREAKER_MAX_BACKOFF=3600
+MY_BREAKER_PROBE_TIMEOUT=0.5
+
+# Concurrent runs of the plugin share a single poll of all units: a refresh waits for the
+# poll in progress and shows its result, as does a refresh less than X seconds after the
+# last poll completed, unless a command was sent since
+MY_REFRESH_REUSE=10
+
+# Remember discovered units for X seconds before broadcasting for them again
+MY_HOST_CACHE_TTL=24*3600
+
+# Where cached state is kept between runs
+MY_CACHE_DIR=os.getenv('MYDAIKIN_CACHE_DIR', os.path.join(os.path.expanduser('~'), 'Library', 'Caches', 'mydaikin'))
+
+# Keep a temperature history per unit: at most one sample per X seconds, in fixed size files
+MY_HISTORY_INTERVAL=300
+MY_HISTORY_SAMPLES=8192
+MY_HISTORY_HOURS=24*366
+MY_HISTORY_DAYS=366*10
+
+# Track the energy consumption of every unit, reading the current day at most every X
+# seconds. With a price per kWh, the menu also shows the cost in the given currency
+MY_ENERGY_INTERVAL=3600
+MY_ENERGY_PRICE=None
+MY_ENERGY_CURRENCY='€'
+
+# With --watch, poll all units every X seconds and output what changed
+MY_WATCH_INTERVAL=60
+
+# Add the metrics of every refresh to metrics.prom and metrics.json in the cache directory,
+# where they add up across refreshes
+MY_METRICS_EXPORT=True
+
+# When running with --daemon, poll all units every X seconds and serve their state on this socket
+MY_DAEMON_INTERVAL=60
+MY_DAEMON_SOCKET=os.path.join(MY_CACHE_DIR, 'daemon.sock')
+MY_DAEMON_TIMEOUT=0.5
+
+
+from datetime import date, datetime, timedelta
 
 # Nice ANSI colors
 CEND    = '\33[0m'
@@ -83,22 +180,208 @@ def justify(string,number):
 
 # Daikin bridge code
 
-log = logging.getLogger(__name__)
+class LazyLogger():
+    '''The logger of the plugin, importing and configuring logging on first use'''
+
+    def __init__(self, name):
+        self.name = name
+        self.logger = None
+
+    def configure(self):
+        if self.logger is None:
+            import logging
+            logging.basicConfig()
+            self.logger = logging.getLogger(self.name)
+        return self.logger
+
+    def debug(self, msg, *args, **kwargs):
+        # Debug messages can only have been enabled once logging was imported
+        if 'logging' in sys.modules:
+            self.configure().debug(msg, *args, **kwargs)
+
+
+log = LazyLogger("daikin_airco")
+
+
+# Responses are decoded in a single pass into compact records, one class per
+# endpoint. Every field of a record is decoded once, according to its schema
+
+def decode_string(value):
+    return value
+
+
+def decode_integer(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def decode_boolean(value):
+    try:
+        return bool(int(value))
+    except ValueError:
+        return value
+
+
+def decode_temperature(value):
+    # '-' and '--' mean no reading, other non numeric values such as 'M' are kept as is
+    try:
+        return float(value)
+    except ValueError:
+        if value == '-' or value == '--':
+            return None
+        return value
+
+
+def decode_name(value):
+    from urllib.parse import unquote
+    return unquote(value)
+
+
+def decode_energy(value):
+    # '/' separated counters in units of 0.1 kWh
+    try:
+        return [int(counter) / 10.0 for counter in value.split('/')]
+    except ValueError:
+        return value
+
+
+class Record():
+    '''Typed fields of a response, with read-only mapping access for compatibility'''
+
+    __slots__ = ()
+    schema = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.decoders = {field.encode(): (field, cls.schema.get(field, decode_string)) for field in cls.__slots__}
+
+    def __init__(self, **values):
+        for field in self.__slots__:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def parse(cls, response):
+        '''Decode a raw `ret=OK,key=value,...` response'''
+        items = response.split(b',')
+        check_response(items[0])
+        record = cls()
+        decoders = cls.decoders
+        for item in items[1:]:
+            key, sep, value = item.partition(b'=')
+            decoder = decoders.get(key)
+            if decoder is not None:
+                setattr(record, decoder[0], decoder[1](value.decode()))
+        return record
+
+    @classmethod
+    def parse_raw(cls, response):
+        '''Decode a raw response, also returning all of its values as strings
+
+           The strings are what the `PollSchedule` keeps and what is
+           sent back by a read-modify-write, so both come from a
+           single pass over the response.
+        '''
+        items = response.split(b',')
+        check_response(items[0])
+        record = cls()
+        raw = {}
+        decoders = cls.decoders
+        for item in items[1:]:
+            if not item:
+                continue
+            key, sep, value = item.partition(b'=')
+            value = value.decode()
+            raw[key.decode()] = value
+            decoder = decoders.get(key)
+            if decoder is not None:
+                setattr(record, decoder[0], decoder[1](value))
+        return record, raw
+
+    @classmethod
+    def from_raw(cls, x):
+        '''Decode a dictionary of raw string values'''
+        record = cls()
+        for field, decoder in cls.decoders.values():
+            if field in x:
+                setattr(record, field, decoder(x[field]))
+        return record
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except (AttributeError, TypeError):
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def __contains__(self, field):
+        return field in self.__slots__
+
+    def keys(self):
+        return self.__slots__
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.to_dict())
+
+
+class BasicInfo(Record):
+    __slots__ = ('type', 'reg', 'ver', 'rev', 'pow', 'err', 'name', 'mac', 'port', 'pv', 'cpv', 'led', 'adp_kind', 'adp_mode')
+    schema = {'pow': decode_boolean, 'err': decode_integer, 'name': decode_name, 'port': decode_integer,
+              'pv': decode_integer, 'cpv': decode_integer, 'led': decode_boolean}
+
+
+class SensorInfo(Record):
+    __slots__ = ('htemp', 'hhum', 'otemp', 'err', 'cmpfreq')
+    schema = {'htemp': decode_temperature, 'hhum': decode_temperature, 'otemp': decode_temperature,
+              'err': decode_integer, 'cmpfreq': decode_integer}
+
+
+class ControlInfo(Record):
+    __slots__ = ('pow', 'mode', 'adv', 'stemp', 'shum', 'f_rate', 'f_dir', 'alert', 'b_mode', 'b_stemp', 'b_shum')
+    schema = {'pow': decode_boolean, 'mode': decode_integer, 'stemp': decode_temperature, 'shum': decode_temperature,
+              'alert': decode_integer, 'b_mode': decode_integer, 'b_stemp': decode_temperature, 'b_shum': decode_temperature}
+
+
+class DayPower(Record):
+    # Hourly consumption of today and yesterday
+    __slots__ = ('curr_day_heat', 'prev_1day_heat', 'curr_day_cool', 'prev_1day_cool')
+    schema = {field: decode_energy for field in __slots__}
+
+
+class WeekPower(Record):
+    # Daily consumption of the last 14 days, today first
+    __slots__ = ('s_dayw', 'week_heat', 'week_cool')
+    schema = {'s_dayw': decode_integer, 'week_heat': decode_energy, 'week_cool': decode_energy}
+
+
+class YearPower(Record):
+    # Monthly consumption of this year and last year, January first
+    __slots__ = ('curr_year_heat', 'prev_year_heat', 'curr_year_cool', 'prev_year_cool')
+    schema = {field: decode_energy for field in __slots__}
+
+
+class ModelInfo(Record):
+    # Features of the indoor unit: settable fan rate and direction, swing directions
+    __slots__ = ('model', 'type', 'en_frate', 'en_fdir', 's_fdir')
+    schema = {'en_frate': decode_boolean, 'en_fdir': decode_boolean, 's_fdir': decode_integer}
 
 
 def parse_basic_info(x):
-    integers = ['port', 'err', 'pv']
-    booleans = ['pow', 'led']
-    parse_data(x, integers=integers, booleans=booleans)
-    x['name'] = urllib.parse.unquote(x['name'])
-    return x
+    return BasicInfo.from_raw(x)
 
 
 def parse_sensor_info(x):
-    integers = ['err']
-    temps = ['hhum', 'htemp', 'otemp']
-    parse_data(x, integers=integers, temps=temps)
-    return x
+    return SensorInfo.from_raw(x)
 
 
 ctrl_integers = ['alert', 'mode', 'b_mode']
@@ -106,38 +389,29 @@ ctrl_temps = ['shum', 'stemp', 'b_shum']
 ctrl_booleans = ['pow']
 
 def parse_control_info(x):
-    parse_data(x, integers=ctrl_integers, temps=ctrl_temps, booleans=ctrl_booleans)
-    return x
+    return ControlInfo.from_raw(x)
 
 def format_control_info(x):
     format_data(x, integers=ctrl_integers, temps=ctrl_temps, booleans=ctrl_booleans)
     return x
 
 
-def parse_data(x, integers=[],
-                  booleans=[],
-                  temps=[]):
-
-
-    for field in integers:
-        try:
-            x[field] = int(x[field])
-        except ValueError as e:
-            log.exception("failed to parse field '{}': {}".format(field, e.message))
-
-    for field in booleans:
-        try:
-            x[field] = bool(int(x[field]))
-        except ValueError as e:
-            log.exception("Failed to parse field '{}': {}".format(field, e.message))
+def parse_responses(record, responses, strict=True):
+    '''Decode many raw responses of one endpoint into records
 
-    for field in temps:
+       With strict unset, a response that cannot be decoded yields its
+       RespException instead of raising it.
+    '''
+    parse = record.parse
+    if strict:
+        return [parse(response) for response in responses]
+    records = []
+    for response in responses:
         try:
-            x[field] = parse_temperature(x[field])
-        except ValueError:
-            #log.exception(("Failed to parse field {{'{}':'{}'}}."
-            #               "A temperature was expected").format(field, x[field]))
-            pass
+            records.append(parse(response))
+        except RespException as e:
+            records.append(e)
+    return records
 
 
 def format_data(x, strict=True,
@@ -167,17 +441,6 @@ def format_data(x, strict=True,
                 pass
 
 
-def parse_temperature(temp):
-        try:
-            return float(temp)
-        except ValueError:
-            if temp == '-' or temp == '--':
-                return None
-            else:
-                raise
-
-
-
 # Daikin specific code
 DSCV_TXT = "DAIKIN_UDP/common/basic_info"
 DSCV_PRT = 30050
@@ -186,8 +449,178 @@ RET_MSG_OK = b'OK'
 RET_MSG_PARAM_NG = b'PARAM NG'
 RET_MSG_ADV_NG = b'ADV_NG'
 
-logging.basicConfig()
-log = logging.getLogger("daikin_airco")
+
+# Instrumentation: latency histograms and error counters, exported as a
+# Prometheus textfile and as JSON
+
+class Metrics():
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = OrderedDict()
+        self.counters = OrderedDict()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            histogram['max'] = max(histogram['max'], seconds)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def to_json(self, reset=False):
+        with self.lock:
+            data = {'histograms': [dict(name=name, labels=dict(labels), **histogram)
+                                   for (name, labels), histogram in self.histograms.items()],
+                    'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in self.counters.items()],
+                    'buckets': list(self.BUCKETS)}
+            if reset:
+                self.histograms = OrderedDict()
+                self.counters = OrderedDict()
+            return data
+
+    def add(self, data):
+        '''Add metrics as returned by `to_json`, e.g. of another process'''
+        if data.get('buckets') != list(self.BUCKETS):
+            return
+        with self.lock:
+            for h in data['histograms']:
+                key = (h['name'], tuple(sorted(h['labels'].items())))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0, 'max': 0.0}
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], h['buckets'])]
+                histogram['sum'] += h['sum']
+                histogram['count'] += h['count']
+                histogram['max'] = max(histogram['max'], h['max'])
+            for c in data['counters']:
+                key = (c['name'], tuple(sorted(c['labels'].items())))
+                self.counters[key] = self.counters.get(key, 0) + c['value']
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', bound)]), count))
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', '+Inf')]), histogram['count']))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram['sum']))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram['count']))
+            for (name, labels), value in self.counters.items():
+                if name not in typed:
+                    lines.append('# TYPE {} counter'.format(name))
+                    typed.add(name)
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        '''Add the metrics since the last export to metrics.json and metrics.prom
+
+           Most refreshes run in a process of their own, so counters
+           and histograms are added to those exported before, under
+           metrics.lock, and start again from zero in this process.
+        '''
+        total = Metrics()
+        with cache_lock('metrics.lock'):
+            total.add(load_cache('metrics.json', {}))
+            total.add(self.to_json(reset=True))
+            save_cache('metrics.json', total.to_json())
+            try:
+                path = os.path.join(MY_CACHE_DIR, 'metrics.prom')
+                tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+                with open(tmp, 'w') as f:
+                    f.write(total.to_prometheus())
+                os.replace(tmp, path)
+            except (IOError, OSError) as e:
+                log.debug("Metrics: failed to export: {}".format(e))
+
+    def profile(self):
+        '''Human readable timing breakdown, slowest first'''
+        data = self.to_json()
+        lines = ['Timing breakdown']
+        for h in sorted(data['histograms'], key=lambda h: -h['sum']):
+            labels = ' '.join('{}={}'.format(k, v) for k, v in sorted(h['labels'].items()))
+            lines.append('  {:<34} {:<48} n={:<3} avg={:.3f}s max={:.3f}s'.format(
+                h['name'], labels, h['count'], h['sum'] / max(1, h['count']), h['max']))
+        if len(data['counters']) > 0:
+            lines.append('Counters')
+            for c in data['counters']:
+                labels = ' '.join('{}={}'.format(k, v) for k, v in sorted(c['labels'].items()))
+                lines.append('  {:<34} {:<48} {}'.format(c['name'], labels, c['value']))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class UnitSnapshot():
+    '''Parsed basic, control and sensor info of a single unit
+
+       Fetched once per refresh, so that the property getters of
+       `Aircon` do not each trigger a new round trip to the unit.
+    '''
+
+    def __init__(self, host, basic_info=None, control_info=None, sensor_info=None, requests=0):
+        self.host = host
+        self.basic_info = basic_info
+        self.control_info = control_info
+        self.sensor_info = sensor_info
+        self.requests = requests
+        self.timestamp = time.time()
+
+    def to_dict(self):
+        return {'host': self.host,
+                'basic_info': self.basic_info.to_dict(),
+                'control_info': self.control_info.to_dict(),
+                'sensor_info': self.sensor_info.to_dict(),
+                'requests': self.requests,
+                'timestamp': self.timestamp}
+
+    @classmethod
+    def from_dict(cls, d):
+        snapshot = cls(d['host'], BasicInfo(**d['basic_info']), ControlInfo(**d['control_info']),
+                       SensorInfo(**d['sensor_info']), d['requests'])
+        snapshot.timestamp = d['timestamp']
+        return snapshot
+
+    def __repr__(self):
+        return "<UnitSnapshot: '{}' ({} requests)>".format(self.host, self.requests)
 
 
 class Aircon():
@@ -198,9 +631,54 @@ class Aircon():
     MODE_HEAT = 4
     MODE_FAN = 6
 
-    def __init__(self, host):
+    def __init__(self, host, timeout=None, pooled=True):
         self.host = host
+        self.timeout = timeout
+        self.pooled = pooled
         self._http_conn = None
+        self._snapshot = None
+        self.requests = 0
+        self.cached_control_info = None
+        self.raw_infos = {}
+        self.fetched = []
+        self.capabilities = None
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        '''Aircon whose getters read from a snapshot taken elsewhere'''
+        unit = cls(snapshot.host)
+        unit._snapshot = snapshot
+        return unit
+
+    def snapshot(self, basic_info=None, control_info=None, sensor_info=None):
+        '''Fetch basic, control and sensor info once
+
+           The returned `UnitSnapshot` is kept on the instance and
+           the getters below read from it until it is invalidated
+           by a `set_*` call. Raw infos that are still fresh, e.g.
+           the basic info received during discovery or infos kept
+           by the `PollSchedule`, save their request. The raw infos
+           are kept in `raw_infos`, the names of the endpoints that
+           were actually requested in `fetched`.
+        '''
+        self._snapshot = None
+        start = self.requests
+        raw_infos = {'basic_info': basic_info, 'control_info': control_info, 'sensor_info': sensor_info}
+        records = {}
+        self.fetched = []
+        for endpoint, record, url in [('basic_info', BasicInfo, '/common/basic_info'),
+                                      ('control_info', ControlInfo, '/aircon/get_control_info'),
+                                      ('sensor_info', SensorInfo, '/aircon/get_sensor_info')]:
+            if raw_infos[endpoint] is None:
+                records[endpoint], raw_infos[endpoint] = self.parse_request(record.parse_raw, 'GET', url)
+                self.fetched.append(endpoint)
+            else:
+                records[endpoint] = record.from_raw(raw_infos[endpoint])
+        self.raw_infos = raw_infos
+        self.cached_control_info = raw_infos['control_info']
+        self._snapshot = UnitSnapshot(self.host, records['basic_info'], records['control_info'],
+                                      records['sensor_info'], requests=self.requests - start)
+        return self._snapshot
 
     def get_name(self):
         return self.get_basic_info()['name']
@@ -218,7 +696,7 @@ class Aircon():
     firmware_version = property(get_firmware_version)
 
     def set_power(self, v):
-        self.set_control_info({'pow': v})
+        return self.set_control_info({'pow': v})
 
     def get_power(self):
         return self.get_control_info()['pow']
@@ -229,7 +707,7 @@ class Aircon():
         return self.get_control_info()['stemp']
 
     def set_target_temp(self, v):
-        self.set_control_info({'stemp': v})
+        return self.set_control_info({'stemp': v})
 
     target_temp = property(get_target_temp, set_target_temp)
 
@@ -237,7 +715,7 @@ class Aircon():
         return self.get_control_info()['mode']
 
     def set_mode(self, v):
-        self.set_control_info({'mode': v})
+        return self.set_control_info({'mode': v})
 
     mode = property(get_mode, set_mode)
 
@@ -245,7 +723,7 @@ class Aircon():
         return self.get_control_info()['f_rate']
 
     def set_frate(self,v):
-        self.set_control_info({'f_rate': v})
+        return self.set_control_info({'f_rate': v})
 
     rate = property(get_frate, set_frate)
 
@@ -253,7 +731,7 @@ class Aircon():
         return self.get_control_info()['f_dir']
 
     def set_fdir(self,v):
-        self.set_control_info({'f_dir': v})
+        return self.set_control_info({'f_dir': v})
 
     fdir = property(get_fdir, set_fdir)
 
@@ -274,30 +752,73 @@ class Aircon():
         return self.send_request('GET', '/common/basic_info')
 
     def get_basic_info(self):
-        return parse_basic_info(self.get_raw_basic_info())
+        if self._snapshot is not None:
+            return self._snapshot.basic_info
+        return self.parse_request(BasicInfo.parse, 'GET', '/common/basic_info')
 
     def get_raw_sensor_info(self):
         return self.send_request('get', '/aircon/get_sensor_info')
 
     def get_sensor_info(self):
-        return parse_sensor_info(self.get_raw_sensor_info())
+        if self._snapshot is not None:
+            return self._snapshot.sensor_info
+        return self.parse_request(SensorInfo.parse, 'GET', '/aircon/get_sensor_info')
 
     def set_raw_control_info(self, params, update=True):
+        '''Set control info, returning the resulting raw control info
+
+           With update, the fields that are not set are taken from
+           `cached_control_info` when present, saving a read of the
+           current state before every write.
+        '''
+        state = None
         if update:
-            cinfo = self.get_raw_control_info()
+            cinfo = self.cached_control_info
+            if cinfo is None:
+                cinfo = self.get_raw_control_info()
             minimal_cinfo = {k:cinfo[k] for k in cinfo if k in ['pow','mode','stemp', 'shum','f_rate','f_dir']}
             minimal_cinfo.update(params)
             params = minimal_cinfo
+            state = dict(cinfo)
+            state.update(params)
+        self._snapshot = None
+        self.cached_control_info = None
         self.send_request('GET', '/aircon/set_control_info', fields=params)
+        self.cached_control_info = state
+        return state
 
     def set_control_info(self, params, update=True):
-        return self.set_raw_control_info(format_control_info(params), update)
+        '''Set control info, checked against `capabilities` when known'''
+        if self.capabilities is not None:
+            mode = params.get('mode', (self.cached_control_info or {}).get('mode'))
+            self.capabilities.check(params, mode)
+        return self.set_raw_control_info(format_control_info(dict(params)), update)
+
+    def get_model_info(self):
+        return self.parse_request(ModelInfo.parse, 'GET', '/aircon/get_model_info')
+
+    def get_day_power(self):
+        return self.parse_request(DayPower.parse, 'GET', '/aircon/get_day_power_ex')
+
+    def get_week_power(self):
+        return self.parse_request(WeekPower.parse, 'GET', '/aircon/get_week_power_ex')
+
+    def get_year_power(self):
+        return self.parse_request(YearPower.parse, 'GET', '/aircon/get_year_power_ex')
+
+    def get_today_energy(self):
+        day = self.get_day_power()
+        return sum(day['curr_day_heat']) + sum(day['curr_day_cool'])
+
+    today_energy = property(get_today_energy)
 
     def get_raw_control_info(self):
         return self.send_request('GET', '/aircon/get_control_info')
 
     def get_control_info(self):
-        return parse_control_info(self.get_raw_control_info())
+        if self._snapshot is not None:
+            return self._snapshot.control_info
+        return self.parse_request(ControlInfo.parse, 'GET', '/aircon/get_control_info')
 
     def send_request(self, method, url, fields=None, headers=None, **urlopen_kw):
         '''Send request to air conditioner
@@ -305,112 +826,2055 @@ class Aircon():
            args and kwargs will be passed to
            `urllib3.request.RequestMethods.request`
         '''
+        return self.parse_request(process_response, method, url, fields, headers, **urlopen_kw)
+
+    def parse_request(self, parse, method, url, fields=None, headers=None, **urlopen_kw):
+        '''Send request to air conditioner, decoding the response with `parse`'''
+        data = self.request_data(method, url, fields, headers, **urlopen_kw)
+        try:
+            return parse(data)
+        except RespException as e:
+            metrics.count('mydaikin_response_errors_total', host=self.host, endpoint=url, error=type(e).__name__)
+            raise
+
+    def request_data(self, method, url, fields=None, headers=None, **urlopen_kw):
+        '''Send request to air conditioner, returning the undecoded response
+
+           Requests go through the shared urllib3 pool, or without
+           pooled over a connection of this instance, see `request_direct`.
+        '''
         if self.host is None:
             raise Exception("Cannot send request: host attribute missing")
 
+        if not self.pooled:
+            return self.request_direct(method, url, fields, headers)
+
+        import urllib3
+
         if self._http_conn is None:
-            self._http_conn = urllib3.PoolManager()
+            self._http_conn = get_http_pool()
+
+        self.requests += 1
+        if self.timeout is not None:
+            # Within the connect and read timeouts of the pool
+            urlopen_kw.setdefault('timeout', urllib3.Timeout(connect=MY_HTTP_CONNECT_TIMEOUT,
+                                                             read=MY_HTTP_READ_TIMEOUT,
+                                                             total=self.timeout))
 
-        res = self._http_conn.request(method,
-                                      'http://{}{}'.format(self.host, url),
-                                      fields=fields,
-                                      headers=headers,
-                                      **urlopen_kw)
+        start = time.time()
+        try:
+            res = self._http_conn.request(method,
+                                          'http://{}{}'.format(self.host, url),
+                                          fields=fields,
+                                          headers=headers,
+                                          **urlopen_kw)
+        except urllib3.exceptions.HTTPError as e:
+            reason = getattr(e, 'reason', None) or e
+            metrics.count('mydaikin_request_errors_total', host=self.host, endpoint=url, error=type(reason).__name__)
+            if isinstance(reason, urllib3.exceptions.TimeoutError):
+                metrics.count('mydaikin_request_timeouts_total', host=self.host, endpoint=url)
+            raise
+        finally:
+            metrics.observe('mydaikin_request_seconds', time.time() - start, host=self.host, endpoint=url)
+
+        if res.retries is not None and len(res.retries.history) > 0:
+            metrics.count('mydaikin_request_retries_total', len(res.retries.history), host=self.host, endpoint=url)
         log.debug("Received response from '{}', data: '{}'".format(self.host,res.data))
-        return process_response(res.data)
+        return res.data
+
+    def request_direct(self, method, url, fields=None, headers=None):
+        '''Send request over a plain `http.client` connection
+
+           For a single command, which does not pay for importing
+           urllib3 this way. Failed attempts are retried like in the
+           shared pool, within the same timeouts.
+        '''
+        import http.client
+
+        path = url
+        if fields:
+            from urllib.parse import urlencode
+            path = '{}?{}'.format(url, urlencode(fields))
+        timeout = self.timeout or MY_HTTP_READ_TIMEOUT
+
+        self.requests += 1
+        start = time.time()
+        try:
+            for attempt in range(0, MY_HTTP_RETRIES + 1):
+                try:
+                    if self._http_conn is None:
+                        self._http_conn = http.client.HTTPConnection(self.host, timeout=min(MY_HTTP_CONNECT_TIMEOUT, timeout))
+                        self._http_conn.connect()
+                        self._http_conn.sock.settimeout(min(MY_HTTP_READ_TIMEOUT, timeout))
+                    self._http_conn.request(method, path, headers=headers or {})
+                    data = self._http_conn.getresponse().read()
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    self._http_conn.close()
+                    self._http_conn = None
+                    metrics.count('mydaikin_request_errors_total', host=self.host, endpoint=url, error=type(e).__name__)
+                    if isinstance(e, socket.timeout):
+                        metrics.count('mydaikin_request_timeouts_total', host=self.host, endpoint=url)
+                    if attempt == MY_HTTP_RETRIES:
+                        raise
+                    time.sleep(MY_HTTP_BACKOFF * 2 ** attempt)
+        finally:
+            metrics.observe('mydaikin_request_seconds', time.time() - start, host=self.host, endpoint=url)
+
+        log.debug("Received response from '{}', data: '{}'".format(self.host, data))
+        return data
 
     def __repr__(self):
         return "<Aircon: '{}'>".format(self.host)
 
 
+_http_pool = None
+_http_pool_lock = threading.Lock()
+
+def get_http_pool():
+    '''Module wide keep-alive connection pool, shared by all Aircon instances'''
+    global _http_pool
+    import urllib3
+
+    # urllib3 warns about retries through the handler configured by the logger
+    log.configure()
+    with _http_pool_lock:
+        if _http_pool is None:
+            _http_pool = urllib3.PoolManager(num_pools=MY_HTTP_POOLS,
+                                             maxsize=MY_HTTP_MAXSIZE,
+                                             block=True,
+                                             timeout=urllib3.Timeout(connect=MY_HTTP_CONNECT_TIMEOUT,
+                                                                     read=MY_HTTP_READ_TIMEOUT),
+                                             retries=urllib3.Retry(total=MY_HTTP_RETRIES,
+                                                                   backoff_factor=MY_HTTP_BACKOFF,
+                                                                   redirect=False),
+                                             headers={'Connection': 'keep-alive'})
+        return _http_pool
+
+
 class RespException(Exception):
     pass
 
 
-def process_response(response):
-    '''Transform the air conditioner response into a dictionary
+class ParamNGException(RespException):
+    pass
 
-       If the response doesn't starts with
-       standard prefix @RESPONSE_PREFIX a RespException will be raised.
-    '''
-    rsp = response.split(b',')
-    if (len(rsp) == 0) or (not rsp[0].startswith(b'ret=')):
+
+class AdvNGException(RespException):
+    pass
+
+
+class UnsupportedException(Exception):
+    pass
+
+
+def check_response(ret):
+    '''Raise a RespException unless the `ret=` prefix of a response is OK'''
+    if not ret.startswith(b'ret='):
         raise RespException("Unrecognized data format for the response")
 
-    ret_msg = rsp[0][4:]
+    ret_msg = ret[4:]
     if ret_msg != RET_MSG_OK:
         if ret_msg == RET_MSG_PARAM_NG:
-            raise RespException("Wrong parameters")
+            raise ParamNGException("Wrong parameters")
         elif ret_msg == RET_MSG_ADV_NG:
-            raise RespException("Wrong ADV")
+            raise AdvNGException("Wrong ADV")
         else:
             raise RespException("Unrecognized return message: '{}'".format(ret_msg))
 
-    # Remove the standard prefix
-    rsp = rsp[1:]
-    # Transform the dictionary into a response
-    rsp = {k.decode():v.decode() for k,v in map(lambda s: s.split(b'='), rsp)}
+
+def process_response(response):
+    '''Transform the air conditioner response into a dictionary
+
+       If the response doesn't starts with
+       standard prefix @RESPONSE_PREFIX a RespException will be raised.
+    '''
+    rsp = response.split(b',')
+    check_response(rsp[0])
+
+    # Transform the remainder into a dictionary, values may contain '='
+    rsp = dict(item.decode().partition('=')[::2] for item in rsp[1:] if item)
     return rsp
 
 
-def discover(waitfor=MY_NUMBER_UNITS,
-             timeout=5,
-             listen_address="0.0.0.0",
-             listen_port=0,
-             probe_port=30050,
-             probe_address='255.255.255.255',
-             probe_attempts=10,
-             probe_interval=0.2):
+class DiscoveryProtocol():
+    '''Queues the basic info of every unit answering a discovery probe
+
+       An asyncio datagram protocol, not derived from its base class
+       so that asyncio is only imported when discovering.
+    '''
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def connection_made(self, transport):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        log.debug("Discovery: received response from {} - '{}'".format(addr[0], data))
+        try:
+            self.responses.put_nowait((addr[0], process_response(data)))
+        except RespException as e:
+            log.debug("Discovery: ignoring response from {}: {}".format(addr[0], e))
 
-    discovered = {}
+    def error_received(self, exc):
+        log.debug("Discovery: socket error: {}".format(exc))
 
-    class UDPRequestHandler(socketserver.BaseRequestHandler):
 
-        def handle(self):
-            log.debug("Discovery: received response from {} - '{}'".format(self.client_address[0], self.request[0]))
-            resp = process_response(self.request[0])
-            host = self.client_address[0]
-            discovered[host] = resp
+def broadcast_addresses():
+    '''Directed broadcast address of every local IPv4 subnet'''
+    import ipaddress
+    import re
+    import subprocess
+    addresses = []
+    for command in [['ifconfig'], ['ip', '-o', '-4', 'addr']]:
+        try:
+            output = subprocess.check_output(command, stderr=subprocess.DEVNULL).decode()
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        interfaces  = re.findall(r'inet (?:addr:)?(\d+\.\d+\.\d+\.\d+)\s+(?:netmask|Mask:)\s*(0x[0-9a-f]+|\d+\.\d+\.\d+\.\d+)', output)
+        interfaces += re.findall(r'inet (\d+\.\d+\.\d+\.\d+)/(\d+)', output)
+        for address, netmask in interfaces:
+            if netmask.startswith('0x'):
+                netmask = str(ipaddress.IPv4Address(int(netmask, 16)))
+            interface = ipaddress.IPv4Interface('{}/{}'.format(address, netmask))
+            if interface.ip.is_loopback or interface.network.prefixlen >= 31:
+                continue
+            broadcast = str(interface.network.broadcast_address)
+            if broadcast not in addresses:
+                addresses.append(broadcast)
+        if len(interfaces) > 0:
+            break
+    return addresses
+
+
+async def discover_iter(waitfor=MY_NUMBER_UNITS,
+                        expected=None,
+                        timeout=5,
+                        quiet=MY_DISCOVERY_QUIET,
+                        listen_address="0.0.0.0",
+                        listen_port=0,
+                        probe_port=30050,
+                        probe_address=None,
+                        probe_attempts=10,
+                        probe_interval=0.2,
+                        subnets=MY_DISCOVERY_SUBNETS,
+                        sweep_rate=MY_DISCOVERY_SWEEP_RATE):
+    '''Yield (host, basic info) for every unit as soon as it responds
+
+       Probes are broadcast on `probe_address`, by default the limited
+       broadcast address and the directed broadcast address of every
+       local subnet, with a growing interval. The hosts of `subnets`
+       are swept once with unicast probes, at most `sweep_rate` per
+       second. All probes go out of a single socket, and responses are
+       deduplicated by MAC address.
+
+       Discovery ends after `timeout`, once no new unit responded for
+       `quiet` seconds after the sweep, once `waitfor` units answered,
+       or once every MAC address in `expected` answered.
+    '''
+    import asyncio
+    import ipaddress
+
+    loop = asyncio.get_running_loop()
+    responses = asyncio.Queue()
+    expected = set(expected or [])
+    awaited = len(expected) > 0
+    seen = set()
+
+    if probe_address is None:
+        probe_addresses = ['255.255.255.255'] + broadcast_addresses()
+    elif isinstance(probe_address, str):
+        probe_addresses = [probe_address]
+    else:
+        probe_addresses = list(probe_address)
 
     sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sckt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sckt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sckt.bind((listen_address, listen_port))
+    transport, protocol = await loop.create_datagram_endpoint(lambda: DiscoveryProtocol(responses), sock=sckt)
+
+    async def probe():
+        interval = probe_interval
+        for i in range(0, probe_attempts):
+            for address in probe_addresses:
+                log.debug("Discovery: probe attempt {} on {}:{}".format(i, address, probe_port))
+                transport.sendto(DSCV_TXT.encode(), (address, probe_port))
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, 1.0)
+
+    async def sweep():
+        nonlocal swept
+        batch = max(1, sweep_rate // 20)
+        sent = 0
+        for subnet in subnets:
+            log.debug("Discovery: sweeping {}".format(subnet))
+            for address in ipaddress.ip_network(subnet, strict=False).hosts():
+                transport.sendto(DSCV_TXT.encode(), (str(address), probe_port))
+                sent += 1
+                if sent % batch == 0:
+                    await asyncio.sleep(batch / float(sweep_rate))
+        swept = loop.time()
+
+    start = loop.time()
+    swept = start
+    last_response = None
+    prober = loop.create_task(probe())
+    sweeper = loop.create_task(sweep())
 
-    server = socketserver.ThreadingUDPServer((listen_address, listen_port), UDPRequestHandler)
-    server.socket = sckt
-    srv_addr, srv_port = server.server_address
-
-    server_thread = threading.Thread(target=server.serve_forever)
-    # Exit the server thread when the main thread terminates
-    server_thread.daemon = True
-    log.debug("Discovery: starting UDP server on {}:{}".format(srv_addr, srv_port))
-    server_thread.start()
-
-    for i in range(0, probe_attempts):
-        log.debug("Discovery: probe attempt {} on {}:{}".format(i, probe_address, probe_port))
-        sckt.sendto(DSCV_TXT.encode(), (probe_address, probe_port))
-        log.debug("Discovery: sleeping for {}s".format(probe_interval))
-        time.sleep(probe_interval)
-        if len(discovered) >= waitfor:
+    try:
+        while True:
+            now = loop.time()
+            wait = start + timeout - now
+            if not sweeper.done():
+                wait = min(wait, quiet)
+            elif last_response is not None:
+                wait = min(wait, max(last_response, swept) + quiet - now)
+            if wait <= 0:
+                break
+            try:
+                host, info = await asyncio.wait_for(responses.get(), wait)
+            except asyncio.TimeoutError:
+                if sweeper.done() and (last_response is not None or loop.time() >= start + timeout):
+                    break
+                continue
+            key = info.get('mac', host)
+            if key in seen:
+                continue
+            last_response = loop.time()
+            seen.add(key)
+            expected.discard(info.get('mac'))
+            metrics.observe('mydaikin_discovery_response_seconds', last_response - start, host=host)
+            yield host, info
+            if waitfor is not None and len(seen) >= waitfor:
+                break
+            if awaited and len(expected) == 0:
+                break
+    finally:
+        prober.cancel()
+        sweeper.cancel()
+        transport.close()
+        metrics.observe('mydaikin_discovery_seconds', loop.time() - start)
+        metrics.count('mydaikin_discovery_units_total', len(seen))
+
+
+def iter_discover(**kwargs):
+    '''Synchronous generator over `discover_iter`'''
+    import asyncio
+    loop = asyncio.new_event_loop()
+    units = discover_iter(**kwargs)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(units.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(units.aclose())
+        loop.close()
+
+
+def discover(**kwargs):
+    return OrderedDict(iter_discover(**kwargs))
+
+
+def iter_poll_units(hosts,
+                    deadline=MY_REFRESH_DEADLINE,
+                    unit_timeout=MY_UNIT_TIMEOUT,
+                    workers=MY_POLL_WORKERS,
+                    basic_infos=None,
+                    cached=None,
+                    after=None):
+    '''Snapshot all units in parallel, yielding them as they are polled
+
+       Yields every host with its polled `Aircon` as soon as it was
+       polled, or with None when the unit failed. Units that did not
+       answer before the deadline are yielded with None last. Worker
+       threads are daemonic, so a hanging unit never keeps the refresh
+       from returning. Raw basic infos received during discovery, and
+       raw infos that are not due yet, mapped by host and then by
+       endpoint, are not fetched again. After is called with every
+       polled unit, by its worker; its failures do not fail the unit.
+
+       Hosts may be a generator, e.g. fed by discovery: units are then
+       polled as soon as they are yielded.
+    '''
+    import queue
+
+    basic_infos = basic_infos if basic_infos is not None else {}
+    cached = cached or {}
+    order = []
+    results = {}
+    threads = []
+    pending = queue.Queue()
+    done = queue.Queue()
+    fed = threading.Event()
+
+    def worker():
+        while True:
+            host = pending.get()
+            if host is None:
+                return
+            unit = Aircon(host, timeout=unit_timeout)
+            infos = dict(cached.get(host, {}))
+            if basic_infos.get(host) is not None:
+                infos['basic_info'] = basic_infos[host]
+            try:
+                unit.snapshot(**infos)
+            except Exception as e:
+                log.debug("Polling: unit {} failed: {}".format(host, e))
+                unit = None
+            if unit is not None and after is not None:
+                try:
+                    after(unit)
+                except Exception as e:
+                    log.debug("Polling: unit {} failed after polling: {}".format(host, e))
+            done.put((host, unit))
+
+    def feeder():
+        try:
+            for host in hosts:
+                order.append(host)
+                if len(threads) < workers:
+                    thread = threading.Thread(target=worker)
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                pending.put(host)
+        except Exception as e:
+            log.debug("Polling: failed to enumerate units: {}".format(e))
+        finally:
+            for thread in threads:
+                pending.put(None)
+            fed.set()
+            done.put(None)
+
+    thread = threading.Thread(target=feeder)
+    thread.daemon = True
+    thread.start()
+
+    start = time.time()
+    end = start + deadline
+    while not (fed.is_set() and len(results) >= len(order)):
+        remaining = end - time.time()
+        if remaining <= 0:
+            log.debug("Polling: deadline reached, {} units unanswered".format(len(order) - len(results)))
             break
+        try:
+            item = done.get(timeout=remaining)
+        except queue.Empty:
+            continue
+        if item is not None:
+            results[item[0]] = item[1]
+            yield item
+
+    metrics.observe('mydaikin_poll_seconds', time.time() - start)
+    metrics.count('mydaikin_poll_unanswered_total', len(order) - sum(1 for unit in results.values() if unit is not None))
+    for host in list(order):
+        if host not in results:
+            yield host, None
+
+
+# Cache of discovered units, keyed by MAC address
+
+def load_cache(name, default=None):
+    try:
+        with open(os.path.join(MY_CACHE_DIR, name), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def save_cache(name, data):
+    try:
+        if not os.path.isdir(MY_CACHE_DIR):
+            os.makedirs(MY_CACHE_DIR)
+        path = os.path.join(MY_CACHE_DIR, name)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except (IOError, OSError) as e:
+        log.debug("Cache: failed to write {}: {}".format(name, e))
+
+
+@contextlib.contextmanager
+def cache_lock(name, timeout=None):
+    '''Exclusive lock on a lock file in the cache directory, across processes
+
+       Yields whether the lock was acquired, which is always the case
+       without timeout. With a timeout, gives up waiting after timeout
+       seconds.
+    '''
+    if not os.path.isdir(MY_CACHE_DIR):
+        os.makedirs(MY_CACHE_DIR)
+    with open(os.path.join(MY_CACHE_DIR, name), 'a') as lock:
+        if timeout is None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            acquired = True
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    acquired = True
+                    break
+                except (IOError, OSError):
+                    if time.time() >= deadline:
+                        acquired = False
+                        break
+                    time.sleep(0.05)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_host_cache():
+    return load_cache('hosts.json', {})
+
+
+def save_host_cache(cache):
+    save_cache('hosts.json', cache)
+
+
+def update_host_cache(cache, discovered, now=None):
+    '''Record discovered units by MAC, re-mapping units that changed IP'''
+    now = now or time.time()
+    for host, info in discovered.items():
+        if 'mac' not in info:
+            continue
+        cache[info['mac']] = {'ip': host, 'name': info.get('name', host), 'last_seen': now}
+    for mac in list(cache.keys()):
+        if now - cache[mac]['last_seen'] > MY_HOST_CACHE_TTL:
+            del cache[mac]
+    return cache
+
+
+def cached_units(cache, ttl=MY_HOST_CACHE_TTL, now=None):
+    '''Units from the cache, or None when it is empty or expired'''
+    now = now or time.time()
+    if len(cache) == 0:
+        return None
+    if ttl is not None and any(now - entry['last_seen'] > ttl for entry in cache.values()):
+        return None
+    return OrderedDict((entry['ip'], {'mac': mac, 'name': entry['name']})
+                       for mac, entry in sorted(cache.items(), key=lambda item: item[1]['name']))
+
+
+class PollSchedule():
+    '''Raw infos of every unit, each with its own expiry
+
+       Kept in schedule.json as host, endpoint -> time, expiry and raw
+       info. Endpoints that are not due are served from here instead
+       of being requested again, see the MY_POLL_* settings. Changes
+       are written to the current schedule.json under schedule.lock,
+       so that the changes of concurrent processes, e.g. of a command
+       sent during a refresh, are all kept.
+    '''
+
+    ENDPOINTS = ['basic_info', 'control_info', 'sensor_info']
+
+    def __init__(self, now=None):
+        self.now = now or time.time()
+        self.entries = load_cache('schedule.json', {})
+        self.changes = []
+
+    def ttl(self, endpoint, snapshot):
+        if endpoint == 'basic_info':
+            return MY_POLL_BASIC_INFO
+        if endpoint == 'control_info':
+            return MY_POLL_CONTROL_INFO
+        control, sensor = snapshot.control_info, snapshot.sensor_info
+        if not control.get('pow'):
+            return MY_POLL_SENSOR_OFF
+        htemp, stemp = sensor.get('htemp'), control.get('stemp')
+        if isinstance(htemp, float) and isinstance(stemp, float) and abs(htemp - stemp) <= MY_POLL_SENSOR_DELTA:
+            return MY_POLL_SENSOR_STABLE
+        return MY_POLL_SENSOR_ACTIVE
+
+    def fresh(self, host):
+        '''Raw infos of a unit that are not due yet, by endpoint
+
+           The basic info is only served from here when no other
+           endpoint is due either: whenever a unit is requested at
+           all, its basic info is requested too, so that a unit that
+           moved to another address is never taken for the one that
+           was there before.
+        '''
+        fresh = {endpoint: entry['raw'] for endpoint, entry in self.entries.get(host, {}).items()
+                 if entry['expires'] - MY_POLL_SLACK > self.now}
+        if any(endpoint not in fresh for endpoint in self.ENDPOINTS):
+            fresh.pop('basic_info', None)
+        return fresh
+
+    def recent(self, host, endpoint, age):
+        '''Raw info of a unit if it was read or set less than age seconds ago'''
+        entry = self.entries.get(host, {}).get(endpoint)
+        if entry is None or self.now - entry['time'] > age:
+            return None
+        return entry['raw']
+
+    def store(self, host, endpoint, raw, ttl):
+        if raw is not None:
+            entry = {'time': self.now, 'expires': self.now + ttl, 'raw': raw}
+            self.entries.setdefault(host, {})[endpoint] = entry
+            self.changes.append((host, endpoint, entry))
+
+    def invalidate(self, host, endpoints=None):
+        for endpoint in (endpoints or self.ENDPOINTS):
+            self.entries.get(host, {}).pop(endpoint, None)
+            self.changes.append((host, endpoint, None))
+
+    def update(self, snapshots):
+        '''Schedule the endpoints that were fetched by a poll'''
+        for host, unit in snapshots.items():
+            if unit is None:
+                continue
+            fresh = self.fresh(host)
+            for endpoint in self.ENDPOINTS:
+                if endpoint not in fresh or fresh[endpoint] != unit.raw_infos.get(endpoint):
+                    self.store(host, endpoint, unit.raw_infos.get(endpoint),
+                               self.ttl(endpoint, unit._snapshot))
+
+    def save(self):
+        '''Apply the changes to schedule.json as written by now
+
+           Entries stored or invalidated by another process after this
+           schedule was loaded are more recent, and are kept.
+        '''
+        with cache_lock('schedule.lock'):
+            entries = load_cache('schedule.json', {})
+            for host, endpoint, entry in self.changes:
+                current = entries.get(host, {}).get(endpoint)
+                if current is not None and current['time'] > self.now:
+                    continue
+                if entry is None:
+                    entries.get(host, {}).pop(endpoint, None)
+                else:
+                    entries.setdefault(host, {})[endpoint] = entry
+            for host in list(entries.keys()):
+                for endpoint, entry in list(entries[host].items()):
+                    if entry['expires'] <= self.now:
+                        del entries[host][endpoint]
+                if len(entries[host]) == 0:
+                    del entries[host]
+            save_cache('schedule.json', entries)
+        self.entries = entries
+        self.changes = []
+
+
+class UnitHealth():
+    '''Circuit breaker of every unit
+
+       Kept in health.json as host -> consecutive failures, offline
+       since, next attempt and the last known snapshot. A unit that
+       failed MY_BREAKER_FAILURES polls in a row is skipped until its
+       next attempt, which backs off exponentially.
+    '''
+
+    def __init__(self, now=None):
+        self.now = now or time.time()
+        self.entries = load_cache('health.json', {})
+
+    def skipped(self, host):
+        entry = self.entries.get(host)
+        return (entry is not None and entry['failures'] >= MY_BREAKER_FAILURES and
+                self.now < entry['retry'])
+
+    def succeeded(self, host, unit):
+        self.entries[host] = {'failures': 0, 'since': None, 'retry': 0,
+                              'snapshot': unit._snapshot.to_dict()}
+
+    def failed(self, host):
+        entry = self.entries.setdefault(host, {'failures': 0, 'since': None, 'retry': 0, 'snapshot': None})
+        entry['failures'] += 1
+        entry['since'] = entry['since'] or self.now
+        entry['last'] = self.now
+        if entry['failures'] >= MY_BREAKER_FAILURES:
+            backoff = MY_BREAKER_BACKOFF * 2 ** (entry['failures'] - MY_BREAKER_FAILURES)
+            entry['retry'] = self.now + min(MY_BREAKER_MAX_BACKOFF, backoff)
+            log.debug("Health: skipping {} for {}s after {} failures".format(host, entry['retry'] - self.now, entry['failures']))
+
+    def probed(self, host, probes):
+        '''Whether a unit accepted a connection since it last failed, see `record_probes`'''
+        entry = self.entries.get(host)
+        return entry is not None and probes.get(host, 0) > entry.get('last', entry['since'] or 0)
+
+    def update(self, snapshots, attempted):
+        for host in attempted:
+            if snapshots.get(host) is not None:
+                self.succeeded(host, snapshots[host])
+            else:
+                self.failed(host)
+
+    def annotate(self, aircos):
+        '''Add offline since and last known state to units that did not answer'''
+        for host, airco in aircos.items():
+            entry = self.entries.get(host)
+            if entry is not None and entry['failures'] > 0:
+                airco['offline_since'] = entry['since']
+                airco['last_known'] = entry['snapshot']
+        return aircos
+
+    def save(self, hosts):
+        self.entries = {host: entry for host, entry in self.entries.items() if host in hosts}
+        save_cache('health.json', self.entries)
+
+
+def probe_unit(host, timeout=MY_BREAKER_PROBE_TIMEOUT):
+    '''Whether a unit accepts a TCP connection on its HTTP port'''
+    address, _, port = host.partition(':')
+    try:
+        socket.create_connection((address, int(port or 80)), timeout=timeout).close()
+        return True
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def probe_units(hosts, timeout=MY_BREAKER_PROBE_TIMEOUT):
+    '''Yield the hosts that accept a connection, as they do, for at most timeout seconds'''
+    import queue
+
+    results = queue.Queue()
+    for host in hosts:
+        thread = threading.Thread(target=lambda host: results.put((host, probe_unit(host, timeout))), args=(host,))
+        thread.daemon = True
+        thread.start()
+    deadline = time.time() + timeout
+    for i in range(0, len(hosts)):
+        try:
+            host, alive = results.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            return
+        if alive:
+            log.debug("Health: {} accepts connections again".format(host))
+            yield host
+
+
+def start_probes(hosts):
+    '''Probe units in a background process, which outlives the refresh
+
+       The refresh does not wait for the probes: the units that accept
+       a connection are kept in probes.json by `record_probes`, and
+       polled again by the next refresh.
+    '''
+    import subprocess
+
+    try:
+        subprocess.Popen([sys.executable, cmd_path, '--probe'] + list(hosts),
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         env=dict(os.environ, MYDAIKIN_CACHE_DIR=MY_CACHE_DIR), start_new_session=True)
+    except (IOError, OSError) as e:
+        log.debug("Health: failed to start probes: {}".format(e))
+
+
+def record_probes(hosts, timeout=MY_BREAKER_PROBE_TIMEOUT):
+    '''Probe units, keeping when they accepted a connection in probes.json'''
+    with cache_lock('probes.lock', timeout=0) as acquired:
+        # Another process is probing already
+        if not acquired:
+            return
+        accepted = list(probe_units(hosts, timeout))
+        now = time.time()
+        probes = load_cache('probes.json', {})
+        probes.update((host, now) for host in accepted)
+        save_cache('probes.json', {host: t for host, t in probes.items() if now - t < MY_BREAKER_MAX_BACKOFF})
+
+
+# History: fixed width records in memory mapped ring buffers, one set per unit
+
+HISTORY_MAGIC = b'MDKH'
+HISTORY_HEADER = struct.Struct('<4sHHII')                  # magic, version, record size, capacity, count
+HISTORY_SAMPLE = struct.Struct('<IhhhBB')                  # time, htemp, otemp, stemp, pow, mode
+HISTORY_AGGREGATE = struct.Struct('<IhhiHhhiHH')           # time, htemp min/max/sum/n, otemp min/max/sum/n, samples on
+HISTORY_NONE = -32768
+
+
+class RingBuffer():
+    '''Fixed capacity file of fixed width records, memory mapped
+
+       Appending overwrites the oldest record once the buffer is full,
+       so the file never grows beyond its header and capacity.
+    '''
+
+    def __init__(self, path, record, capacity):
+        import mmap
+
+        self.record = record
+        self.capacity = capacity
+        size = HISTORY_HEADER.size + record.size * capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HISTORY_HEADER.size, 0)
+            if (len(header) < HISTORY_HEADER.size or
+                HISTORY_HEADER.unpack(header)[:4] != (HISTORY_MAGIC, 1, record.size, capacity) or
+                os.fstat(fd).st_size != size):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HISTORY_HEADER.pack(HISTORY_MAGIC, 1, record.size, capacity, 0), 0)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def __len__(self):
+        return HISTORY_HEADER.unpack_from(self.map, 0)[4]
+
+    def _offset(self, index):
+        return HISTORY_HEADER.size + self.record.size * (index % self.capacity)
+
+    def append(self, values):
+        count = len(self)
+        self.record.pack_into(self.map, self._offset(count), *values)
+        HISTORY_HEADER.pack_into(self.map, 0, HISTORY_MAGIC, 1, self.record.size, self.capacity, count + 1)
+
+    def replace_last(self, values):
+        self.record.pack_into(self.map, self._offset(len(self) - 1), *values)
+
+    def last(self):
+        count = len(self)
+        if count == 0:
+            return None
+        return self.record.unpack_from(self.map, self._offset(count - 1))
+
+    def records(self, limit=None):
+        '''Records from oldest to newest, at most the `limit` newest'''
+        count = len(self)
+        size = min(count, self.capacity)
+        if limit is not None:
+            size = min(size, limit)
+        return [self.record.unpack_from(self.map, self._offset(i)) for i in range(count - size, count)]
+
+    def close(self):
+        self.map.close()
+
+
+def pack_temperature(temp):
+    if temp is None or not isinstance(temp, (int, float)):
+        return HISTORY_NONE
+    return int(round(temp * 10))
+
+
+def unpack_temperature(temp):
+    return None if temp == HISTORY_NONE else temp / 10.0
+
+
+class UnitHistory():
+    '''Samples and hourly and daily aggregates of a single unit'''
+
+    def __init__(self, mac, path=None):
+        path = path or os.path.join(MY_CACHE_DIR, 'history')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.lock = os.path.join(path, '{}.lock'.format(mac))
+        self.samples = RingBuffer(os.path.join(path, '{}.samples'.format(mac)), HISTORY_SAMPLE, MY_HISTORY_SAMPLES)
+        self.hours = RingBuffer(os.path.join(path, '{}.hours'.format(mac)), HISTORY_AGGREGATE, MY_HISTORY_HOURS)
+        self.days = RingBuffer(os.path.join(path, '{}.days'.format(mac)), HISTORY_AGGREGATE, MY_HISTORY_DAYS)
+
+    def record(self, snapshot, interval=MY_HISTORY_INTERVAL):
+        '''Append a snapshot, unless the last sample is more recent than `interval`'''
+        now = int(snapshot.timestamp)
+        with open(self.lock, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            last = self.samples.last()
+            if last is not None and 0 <= now - last[0] < interval:
+                return False
+            htemp = pack_temperature(snapshot.sensor_info.get('htemp'))
+            otemp = pack_temperature(snapshot.sensor_info.get('otemp'))
+            stemp = pack_temperature(snapshot.control_info.get('stemp'))
+            power = int(bool(snapshot.control_info.get('pow')))
+            try:
+                mode = int(snapshot.control_info.get('mode', 0)) & 0xff
+            except (TypeError, ValueError):
+                mode = 0
+            self.samples.append((now, htemp, otemp, stemp, power, mode))
+            self.aggregate(self.hours, now - now % 3600, htemp, otemp, power)
+            self.aggregate(self.days, int(time.mktime(date.fromtimestamp(now).timetuple())), htemp, otemp, power)
+            return True
+
+    def aggregate(self, buffer, bucket, htemp, otemp, power):
+        last = buffer.last()
+        if last is not None and last[0] == bucket:
+            t, hmin, hmax, hsum, hn, omin, omax, osum, on, pn = last
+            replace = buffer.replace_last
+        else:
+            hmin = hmax = omin = omax = HISTORY_NONE
+            hsum = hn = osum = on = pn = 0
+            replace = buffer.append
+        if htemp != HISTORY_NONE:
+            hmin = htemp if hmin == HISTORY_NONE else min(hmin, htemp)
+            hmax = htemp if hmax == HISTORY_NONE else max(hmax, htemp)
+            hsum += htemp
+            hn += 1
+        if otemp != HISTORY_NONE:
+            omin = otemp if omin == HISTORY_NONE else min(omin, otemp)
+            omax = otemp if omax == HISTORY_NONE else max(omax, otemp)
+            osum += otemp
+            on += 1
+        replace((bucket, hmin, hmax, hsum, hn, omin, omax, osum, on, pn + power))
+
+    def today(self):
+        '''(min, max) indoor temperature of today, or None'''
+        last = self.days.last()
+        if last is None or last[0] != int(time.mktime(date.today().timetuple())) or last[4] == 0:
+            return None
+        return unpack_temperature(last[1]), unpack_temperature(last[2])
+
+    def trend(self, hours=24):
+        '''Mean indoor temperature of the last hours, oldest first'''
+        since = time.time() - hours * 3600
+        return [hsum / 10.0 / hn for t, hmin, hmax, hsum, hn, omin, omax, osum, on, pn in self.hours.records(hours)
+                if t >= since and hn > 0]
+
+    def close(self):
+        self.samples.close()
+        self.hours.close()
+        self.days.close()
+
+
+def sparkline(values):
+    if len(values) == 0:
+        return ''
+    bars = u'▁▂▃▄▅▆▇█'
+    low, high = min(values), max(values)
+    if high == low:
+        return bars[3] * len(values)
+    return u''.join(bars[int((value - low) / (high - low) * (len(bars) - 1))] for value in values)
+
+
+def record_history(snapshots):
+    for host, unit in snapshots.items():
+        if unit is None:
+            continue
+        try:
+            history = UnitHistory(unit.get_mac_address())
+            try:
+                history.record(unit._snapshot)
+            finally:
+                history.close()
+        except (IOError, OSError, KeyError, TypeError, ValueError) as e:
+            log.debug("History: failed to record {}: {}".format(host, e))
+
+
+# Energy consumption: past days and months never change, so they are requested once
+# and kept, only the current day is requested again
+
+class EnergyStats():
+    '''Energy consumption of every unit, in kWh
+
+       Kept in energy.json by MAC: the consumption of past days and
+       months, of today, and the consumption of the current month up
+       to the day its months were last requested. Today is requested
+       at most every MY_ENERGY_INTERVAL seconds, the last 14 days and
+       the months of this and last year only when some of them are
+       missing, i.e. on the first run and once a month.
+    '''
+
+    def __init__(self, now=None):
+        self.now = now or time.time()
+        self.lock = threading.Lock()
+        self.entries = load_cache('energy.json', {})
+
+    def update(self, unit):
+        '''Request the missing consumption of a polled unit'''
+        mac = unit.get_mac_address()
+        today = date.fromtimestamp(self.now)
+        with self.lock:
+            entry = self.entries.setdefault(mac, {'time': 0, 'today': None, 'days': {}, 'months': {}, 'month': None})
+        if entry.get('unsupported') == unit.get_firmware_version():
+            return
+        if entry['today'] is not None and entry['today'][0] == today.isoformat() and self.now - entry['time'] < MY_ENERGY_INTERVAL:
+            return
+        try:
+            day = unit.get_day_power()
+            yesterday = (today - timedelta(days=1)).isoformat()
+            entry['days'].setdefault(yesterday, sum(day['prev_1day_heat']) + sum(day['prev_1day_cool']))
+            entry['today'] = [today.isoformat(), sum(day['curr_day_heat']) + sum(day['curr_day_cool'])]
+            entry['time'] = self.now
+
+            if any((today - timedelta(days=i)).isoformat() not in entry['days'] for i in range(1, 14)):
+                week = unit.get_week_power()
+                for i, (heat, cool) in enumerate(zip(week['week_heat'], week['week_cool'])):
+                    if i > 0:
+                        entry['days'].setdefault((today - timedelta(days=i)).isoformat(), heat + cool)
+
+            month = today.strftime('%Y-%m')
+            past = ['%d-%02d' % (today.year - 1, m) for m in range(1, 13)] + ['%d-%02d' % (today.year, m) for m in range(1, today.month)]
+            if any(m not in entry['months'] for m in past) or (entry['month'] or {}).get('month') != month:
+                year = unit.get_year_power()
+                for m in range(1, 13):
+                    entry['months'].setdefault('%d-%02d' % (today.year - 1, m), year['prev_year_heat'][m - 1] + year['prev_year_cool'][m - 1])
+                for m in range(1, today.month):
+                    entry['months'].setdefault('%d-%02d' % (today.year, m), year['curr_year_heat'][m - 1] + year['curr_year_cool'][m - 1])
+                # Consumption of this month before today
+                entry['month'] = {'month': month, 'upto': yesterday,
+                                  'base': year['curr_year_heat'][today.month - 1] + year['curr_year_cool'][today.month - 1] - entry['today'][1]}
+        except (RespException, TypeError, IndexError) as e:
+            log.debug("Energy: {} does not report consumption: {}".format(unit.host, e))
+            entry['unsupported'] = unit.get_firmware_version()
+
+    def summary(self, macs):
+        '''Consumption today, during the last 7 days, this month and this year
+
+           Returns the totals of the given units, and the consumption
+           of every unit today, or None when no unit reports any.
+        '''
+        today = date.fromtimestamp(self.now)
+        month = today.strftime('%Y-%m')
+        totals = OrderedDict([('today', 0.0), ('week', 0.0), ('month', 0.0), ('year', 0.0)])
+        units = OrderedDict()
+        for mac in macs:
+            entry = self.entries.get(mac)
+            if entry is None or entry['today'] is None:
+                continue
+            days = entry['days']
+            current = entry['today'][1] if entry['today'][0] == today.isoformat() else 0.0
+            week = current + sum(days.get((today - timedelta(days=i)).isoformat(), 0.0) for i in range(1, 7))
+            if (entry['month'] or {}).get('month') == month:
+                this_month = entry['month']['base'] + sum(v for d, v in days.items() if d.startswith(month) and d > entry['month']['upto'])
+            else:
+                this_month = sum(v for d, v in days.items() if d.startswith(month))
+            this_month += current
+            this_year = this_month + sum(v for m, v in entry['months'].items() if m.startswith(str(today.year)))
+            for period, value in zip(totals.keys(), [current, week, this_month, this_year]):
+                totals[period] += value
+            units[mac] = current
+        if len(units) == 0:
+            return None
+        return totals, units
+
+    def save(self):
+        oldest = (date.fromtimestamp(self.now) - timedelta(days=366)).isoformat()
+        for entry in self.entries.values():
+            entry['days'] = {d: v for d, v in entry['days'].items() if d >= oldest}
+        save_cache('energy.json', self.entries)
+
+
+class Capabilities():
+    '''Supported modes, setpoint range per mode, fan rates and swing directions of a unit
+
+       Built from the model info of the adapter, which tells whether
+       the fan rate and direction can be set and in which directions
+       the unit swings, and MY_SETPOINT_RANGES. Units whose adapter
+       does not answer the model info request get everything.
+    '''
+
+    MODES = ['0', '3', '4', '6', '2']
+    # Auto mode reports whether it is cooling or heating
+    AUTO_MODES = {'1': '0', '7': '0'}
+    FRATES = ['A', 'B', '3', '4', '5', '6', '7']
+    FDIRS = ['0', '1', '2', '3']
+
+    def __init__(self, modes=None, ranges=None, frates=None, fdirs=None):
+        self.modes = list(modes or self.MODES)
+        self.ranges = OrderedDict((mode, tuple(r)) for mode, r in (ranges or MY_SETPOINT_RANGES).items())
+        self.frates = list(frates or self.FRATES)
+        self.fdirs = list(fdirs or self.FDIRS)
+
+    @classmethod
+    def from_model_info(cls, model):
+        if model is None:
+            return cls()
+        frates = ['A'] if model['en_frate'] is False else cls.FRATES
+        fdirs = cls.FDIRS
+        if model['en_fdir'] is False:
+            fdirs = ['0']
+        elif isinstance(model['s_fdir'], int) and 0 < model['s_fdir'] < 3:
+            fdirs = ['0', str(model['s_fdir'])]
+        return cls(frates=frates, fdirs=fdirs)
+
+    @classmethod
+    def from_dict(cls, x):
+        return cls(x['modes'], x['ranges'], x['frates'], x['fdirs'])
+
+    def to_dict(self):
+        return {'modes': self.modes, 'ranges': self.ranges, 'frates': self.frates, 'fdirs': self.fdirs}
+
+    def key(self):
+        return (tuple(self.modes), tuple(self.ranges.items()), tuple(self.frates), tuple(self.fdirs))
+
+    def temperatures(self, mode, around=None):
+        '''Setpoints offered in a mode, none in modes without setpoint
+
+           With around, only the MY_SETPOINT_CHOICES setpoints closest
+           to it, e.g. the current setpoint, or the middle of the range
+           when around is not a temperature.
+        '''
+        low, high = self.ranges.get(self.AUTO_MODES.get(str(mode), str(mode)), (0, -1))
+        steps = int(round((high - low) / MY_SETPOINT_STEP))
+        temperatures = ['%.1f' % (low + i * MY_SETPOINT_STEP) for i in range(0, steps + 1)]
+        if around is None or len(temperatures) <= MY_SETPOINT_CHOICES:
+            return temperatures
+        try:
+            index = int(round((float(around) - low) / MY_SETPOINT_STEP))
+        except (TypeError, ValueError):
+            index = len(temperatures) // 2
+        start = max(0, min(len(temperatures) - MY_SETPOINT_CHOICES, index - MY_SETPOINT_CHOICES // 2))
+        return temperatures[start:start + MY_SETPOINT_CHOICES]
+
+    def check(self, changes, mode=None):
+        '''Raise UnsupportedException for changes the unit does not support
+
+           The setpoint is checked against the range of the given mode,
+           or against all ranges when the mode is not known.
+        '''
+        if 'mode' in changes and str(changes['mode']) not in self.modes:
+            raise UnsupportedException('mode {} not supported'.format(changes['mode']))
+        if 'f_rate' in changes and str(changes['f_rate']) not in self.frates:
+            raise UnsupportedException('fan rate {} not supported'.format(changes['f_rate']))
+        if 'f_dir' in changes and str(changes['f_dir']) not in self.fdirs:
+            raise UnsupportedException('fan direction {} not supported'.format(changes['f_dir']))
+        if 'stemp' in changes:
+            # Dry and fan mode have no setpoint
+            ranges = list(self.ranges.values()) if mode is None else [self.ranges.get(self.AUTO_MODES.get(str(mode), str(mode)))]
+            if len(ranges) == 0 or ranges[0] is None:
+                return
+            low, high = min(r[0] for r in ranges), max(r[1] for r in ranges)
+            try:
+                stemp = float(changes['stemp'])
+            except (TypeError, ValueError):
+                if mode is None:
+                    return
+                raise UnsupportedException('temperature {} not supported'.format(changes['stemp']))
+            if not low <= stemp <= high:
+                raise UnsupportedException('temperature {} outside {}-{}'.format(stemp, low, high))
+
+
+class CapabilityCache():
+    '''Capabilities of every unit, see `Capabilities`
+
+       Kept in capabilities.json by MAC and firmware version, so that
+       the model info is requested once per unit and again only after
+       a firmware update, and by host, so that commands are checked
+       without knowing the MAC of the unit.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        cache = load_cache('capabilities.json', {})
+        self.units = cache.get('units', {})
+        self.hosts = cache.get('hosts', {})
+        self.changed = False
+
+    def get(self, mac, ver):
+        '''Capabilities of a unit, everything when not known yet'''
+        entry = self.units.get('{}/{}'.format(mac, ver))
+        return Capabilities() if entry is None else Capabilities.from_dict(entry)
+
+    def for_host(self, host):
+        '''Capabilities of the unit last polled at host, or None'''
+        entry = self.units.get(self.hosts.get(host))
+        return None if entry is None else Capabilities.from_dict(entry)
+
+    def update(self, unit):
+        '''Request the model info of a polled unit that is not known yet'''
+        key = '{}/{}'.format(unit.get_mac_address(), unit.get_firmware_version())
+        if key not in self.units:
+            try:
+                model = unit.get_model_info()
+            except RespException as e:
+                log.debug("Capabilities: {} does not report its model: {}".format(unit.host, e))
+                model = None
+            with self.lock:
+                self.units[key] = Capabilities.from_model_info(model).to_dict()
+                self.changed = True
+        with self.lock:
+            if self.hosts.get(unit.host) != key:
+                self.hosts[unit.host] = key
+                self.changed = True
+
+    def save(self):
+        if self.changed:
+            keys = set(self.hosts.values())
+            self.units = {key: entry for key, entry in self.units.items() if key in keys}
+            save_cache('capabilities.json', {'units': self.units, 'hosts': self.hosts})
+            self.changed = False
+
+
+def iter_fleet():
+    '''Find and snapshot all units, yielding every unit as soon as it is polled
+
+       Cached units are polled right away, their basic info, which
+       is requested whenever anything else is, doubling as
+       revalidation. Only when the cache
+       is empty or expired, or when a cached unit stops answering or
+       answers with another MAC, do we fall back to a broadcast
+       discovery. Endpoints of a unit that are not due according to
+       the `PollSchedule` are not requested at all, and units whose
+       circuit breaker is open are only probed in the background, see
+       `UnitHealth` and `start_probes`.
+       The energy consumption of polled units is updated, and the
+       capabilities of units that are not known yet are requested.
+
+       Yields the host, info and polled `Aircon` of every unit. Units
+       that did not answer come last, with None and their info
+       annotated with their last known state, once the caches have
+       been written.
+    '''
+    cache = load_host_cache()
+    aircos = cached_units(cache)
+    schedule = PollSchedule()
+    health = UnitHealth()
+    energy = EnergyStats()
+    capabilities = CapabilityCache()
+    snapshots = OrderedDict()
+
+    def after(unit):
+        capabilities.update(unit)
+        energy.update(unit)
+
+    if aircos is None:
+        discovered = OrderedDict()
+        def responders():
+            for host, info in iter_discover(waitfor=MY_NUMBER_UNITS, subnets=MY_DISCOVERY_SUBNETS, expected=list(cache.keys())):
+                discovered[host] = info
+                yield host
+        for host, unit in iter_poll_units(responders(), basic_infos=discovered, after=after):
+            snapshots[host] = unit
+            if unit is not None:
+                yield host, discovered[host], unit
+        update_host_cache(cache, discovered)
+        save_host_cache(cache)
+        schedule.update(snapshots)
+        schedule.save()
+        health.update(snapshots, snapshots.keys())
+        health.save(discovered.keys())
+        energy.save()
+        capabilities.save()
+        record_history(snapshots)
+        for host, info in health.annotate(discovered).items():
+            if snapshots.get(host) is None:
+                yield host, info, None
+        return
+
+    probes = load_cache('probes.json', {})
+    skipped = [host for host in aircos.keys() if health.skipped(host) and not health.probed(host, probes)]
+    metrics.count('mydaikin_units_skipped_total', len(skipped))
+    if len(skipped) > 0:
+        start_probes(skipped)
+    candidates = [host for host in aircos.keys() if host not in skipped]
+    attempted = []
+    moved = []
+    for host, unit in iter_poll_units(candidates, cached={host: schedule.fresh(host) for host in aircos.keys()},
+                                      after=after):
+        attempted.append(host)
+        if unit is None or unit.get_mac_address() != aircos[host]['mac']:
+            moved.append(host)
+            continue
+        snapshots[host] = unit
+        yield host, aircos[host], unit
+
+    now = time.time()
+    for host, unit in snapshots.items():
+        if len(unit.fetched) > 0:
+            cache[aircos[host]['mac']]['last_seen'] = now
+
+    if len(moved) > 0:
+        log.debug("Discovery: cached units {} did not revalidate".format(moved))
+        try:
+            discovered = discover(waitfor=None, subnets=MY_DISCOVERY_SUBNETS, expected=[aircos[host]['mac'] for host in moved])
+        except Exception as e:
+            log.debug("Discovery: failed: {}".format(e))
+            discovered = {}
+        update_host_cache(cache, discovered, now)
+        for host in moved:
+            schedule.invalidate(host)
+        aircos = cached_units(cache, ttl=None)
+        # Units that did not answer and were not rediscovered elsewhere are not polled twice
+        missing = [host for host in aircos.keys() if host not in snapshots and host in discovered]
+        for host in missing:
+            schedule.invalidate(host)
+        for host, unit in iter_poll_units(missing, basic_infos=discovered, after=after):
+            attempted.append(host)
+            snapshots[host] = unit
+            if unit is not None:
+                yield host, aircos[host], unit
+
+    snapshots = OrderedDict((host, snapshots.get(host)) for host in aircos.keys())
+    save_host_cache(cache)
+    schedule.update(snapshots)
+    schedule.save()
+    health.update(snapshots, [host for host in aircos.keys() if host in attempted])
+    health.save(aircos.keys())
+    energy.save()
+    capabilities.save()
+    record_history(snapshots)
+    for host, info in health.annotate(aircos).items():
+        if snapshots[host] is None:
+            yield host, info, None
+
+
+def poll_fleet():
+    '''Find and snapshot all units, see `iter_fleet`
+
+       Returns the info and the polled `Aircon` of every unit, or
+       None for units that did not answer, as OrderedDicts sorted
+       by name.
+    '''
+    units = sorted(iter_fleet(), key=lambda unit: unit[1].get('name', unit[0]))
+    return (OrderedDict((host, info) for host, info, unit in units),
+            OrderedDict((host, unit) for host, info, unit in units))
 
-    remaining_time = timeout - (probe_interval * probe_attempts)
-    if (remaining_time > 0) and (len(discovered) < waitfor):
-        log.debug("Discovery: waiting responses for {}s more".format(remaining_time))
-        time.sleep(remaining_time)
 
-    server.shutdown()
-    server.server_close()
+# Polls shared between concurrent runs of the plugin: the result of the last poll of
+# all units is kept in fleet.json, and refresh.lock is held while polling
+
+def load_fleet(since):
+    '''Result of the last poll of all units, see `poll_fleet`
+
+       Returns None when the poll completed before since, or started
+       before the last command was sent.
+    '''
+    result = load_cache('fleet.json')
+    if result is None or result['completed'] < since:
+        return None
+    try:
+        commanded = os.path.getmtime(os.path.join(MY_CACHE_DIR, 'commands.stamp'))
+    except OSError:
+        commanded = 0
+    if result['started'] <= commanded:
+        return None
+    snapshots = OrderedDict()
+    for host, snapshot in result['snapshots']:
+        if snapshot is not None:
+            snapshot = UnitSnapshot.from_dict(snapshot)
+            # No request was sent for it by this process
+            snapshot.requests = 0
+            snapshot = Aircon.from_snapshot(snapshot)
+        snapshots[host] = snapshot
+    return OrderedDict(result['aircos']), snapshots
+
+
+def save_fleet(started, aircos, snapshots):
+    save_cache('fleet.json', {'started': started, 'completed': time.time(), 'aircos': list(aircos.items()),
+                              'snapshots': [(host, unit._snapshot.to_dict() if unit is not None else None)
+                                            for host, unit in snapshots.items()]})
+
+
+def invalidate_fleet():
+    '''Make the next refresh poll, rather than reuse a poll that started before now'''
+    path = os.path.join(MY_CACHE_DIR, 'commands.stamp')
+    try:
+        with open(path, 'a'):
+            pass
+        os.utime(path)
+    except (IOError, OSError) as e:
+        log.debug("Cache: failed to invalidate fleet.json: {}".format(e))
+
+
+def shared_fleet(reuse=None):
+    '''Poll all units, see `poll_fleet`, once for all concurrent processes
+
+       Returns the result of the last poll when it completed less than
+       reuse seconds ago, by default MY_REFRESH_REUSE. Otherwise waits for the poll in progress in
+       another process, if any, and returns its result, or polls. Only
+       when the other poll does not complete in time, e.g. because that
+       process hangs, do both poll at the same time.
+    '''
+    reuse = MY_REFRESH_REUSE if reuse is None else reuse
+    start = time.time()
+    fleet = load_fleet(start - reuse)
+    if fleet is None:
+        with cache_lock('refresh.lock', timeout=2 * MY_REFRESH_DEADLINE):
+            fleet = load_fleet(start - reuse)
+            if fleet is None:
+                started = time.time()
+                aircos, snapshots = poll_fleet()
+                save_fleet(started, aircos, snapshots)
+                return aircos, snapshots
+    metrics.count('mydaikin_refresh_shared_total')
+    return fleet
+
+
+COMMAND_FIELDS = OrderedDict([('set_power', 'pow'), ('set_mode', 'mode'), ('set_target_temp', 'stemp'),
+                              ('set_frate', 'f_rate'), ('set_fdir', 'f_dir')])
+
+CONTROL_FIELDS = ['pow', 'mode', 'stemp', 'shum', 'f_rate', 'f_dir']
+
+
+def command_changes(command, value):
+    '''Control fields changed by a command, or None for unknown commands
+
+       Besides the set_* commands, set_batch changes several fields of
+       a unit at once, e.g. `set_batch mode=4,stemp=21.0,f_rate=A`.
+    '''
+    if command in COMMAND_FIELDS:
+        changes = {COMMAND_FIELDS[command]: value}
+    elif command == 'set_batch':
+        changes = dict(item.partition('=')[::2] for item in value.split(',') if item)
+    else:
+        return None
+    if len(changes) == 0 or any(field not in CONTROL_FIELDS for field in changes):
+        return None
+    if str(changes.get('pow')) == '0':
+        changes['pow'] = False
+    return changes
+
+
+def command_error(e):
+    if isinstance(e, ParamNGException):
+        return 'PARAM NG'
+    if isinstance(e, AdvNGException):
+        return 'ADV_NG'
+    return str(e) or e.__class__.__name__
+
+
+@contextlib.contextmanager
+def pending_commands():
+    '''Changes queued per unit, locked against other processes'''
+    with cache_lock('pending.lock'):
+        pending = load_cache('pending.json', {})
+        yield pending
+        save_cache('pending.json', pending)
+
+
+def run_batch(host, changes, debounce=None):
+    '''Apply several control field changes to a unit in one write
+
+       A click on a unit without a recent write is sent right away.
+       Clicks that follow while the unit is written, or less than
+       MY_COMMAND_DEBOUNCE seconds after, are queued until then, and
+       the process of the last of them sends the changes of all of
+       them in a single write. Returns the result for the unit: ok
+       and the new raw control info, ok and coalesced when a later
+       click took over the changes, or not ok and the error, e.g.
+       'PARAM NG' or 'ADV_NG'. Changes the unit does not support
+       according to its cached `Capabilities` are rejected without
+       sending anything.
+    '''
+    debounce = MY_COMMAND_DEBOUNCE if debounce is None else debounce
+    capabilities = CapabilityCache().for_host(host)
+    if capabilities is not None:
+        try:
+            state = PollSchedule().recent(host, 'control_info', MY_POLL_CONTROL_INFO) or {}
+            capabilities.check(changes, changes.get('mode', state.get('mode')))
+        except UnsupportedException as e:
+            log.debug("Command: {} rejected: {}".format(host, e))
+            return {'ok': False, 'error': command_error(e)}
+
+    if debounce > 0:
+        # Until the write ends, or at most as long as a read and a write may take
+        busy = debounce + 2 * MY_REFRESH_DEADLINE
+        seq = None
+        while True:
+            with pending_commands() as pending:
+                now = time.time()
+                entry = pending.setdefault(host, {'seq': 0, 'changes': {}, 'until': 0})
+                if seq is not None and entry['seq'] != seq:
+                    return {'ok': True, 'coalesced': True}
+                if entry['until'] <= now:
+                    # Send the queued changes along, and let the clicks that queued them return
+                    entry['changes'].update(changes)
+                    changes = entry['changes']
+                    entry['seq'] += 1
+                    entry['changes'] = {}
+                    entry['until'] = now + busy
+                    break
+                if seq is None:
+                    entry['seq'] += 1
+                    entry['changes'].update(changes)
+                    seq = entry['seq']
+                wait = min(entry['until'] - now, debounce)
+            time.sleep(wait)
+
+    try:
+        # Writes to a unit from concurrent processes are sent one at a time
+        with cache_lock('command-{}.lock'.format(host)):
+            # A process sending a single command does not import urllib3 for it
+            target = Aircon(host, timeout=MY_UNIT_TIMEOUT, pooled='urllib3' in sys.modules)
+            target.capabilities = capabilities
+            schedule = PollSchedule()
+            target.cached_control_info = schedule.recent(host, 'control_info', MY_CONTROL_CACHE_TTL)
+            try:
+                state = target.set_control_info(changes)
+            except Exception as e:
+                log.debug("Command: {} failed: {}".format(host, e))
+                return {'ok': False, 'error': command_error(e)}
+
+            schedule = PollSchedule()
+            schedule.store(host, 'control_info', state, MY_POLL_CONTROL_INFO)
+            schedule.invalidate(host, ['sensor_info'])
+            schedule.save()
+    finally:
+        if debounce > 0:
+            # Clicks queued meanwhile are sent once the debounce passed
+            with pending_commands() as pending:
+                if host in pending:
+                    pending[host]['until'] = time.time() + debounce
+    invalidate_fleet()
+    return {'ok': True, 'control_info': state}
+
+
+def run_command(host, command, value):
+    '''Low latency command path
+
+       Does not discover: the host comes from the menu. The control
+       state read or set during the last minute is reused instead of
+       reading it again before the write. The new state is scheduled
+       as fresh control info and the sensor info of the unit is
+       invalidated, so that the refresh following the command shows
+       the change without reading the control info again.
+       Returns the result of `run_batch`, or None for unknown commands.
+    '''
+    changes = command_changes(command, value)
+    if changes is None:
+        return None
+    return run_batch(host, changes)
+
+
+def run_scene(name, hosts=None):
+    '''Apply a scene of MY_SCENES to all units at the same time
+
+       Every unit gets a single write. Returns an OrderedDict with the
+       result of every unit, see `run_batch`, or None for unknown
+       scenes.
+    '''
+    if name not in MY_SCENES:
+        return None
+    changes = command_changes('set_batch', ','.join('{}={}'.format(k, v) for k, v in MY_SCENES[name].items()))
+    if hosts is None:
+        hosts = list((cached_units(load_host_cache(), ttl=None) or {}).keys())
+    results = OrderedDict((host, {'ok': False, 'error': 'timeout'}) for host in hosts)
+
+    def apply(host):
+        results[host] = run_batch(host, changes, debounce=0)
+
+    threads = [threading.Thread(target=apply, args=(host,)) for host in hosts]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    deadline = time.time() + MY_REFRESH_DEADLINE
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    return results
+
+
+# Resident agent: owns discovery, the connection pool and polling, and serves
+# the latest state and accepts commands over a Unix domain socket
+
+class DaikinDaemon():
+
+    def __init__(self, interval=MY_DAEMON_INTERVAL, path=MY_DAEMON_SOCKET):
+        self.interval = interval
+        self.path = path
+        self.lock = threading.Lock()
+        self.aircos = None
+        self.snapshots = None
+        self.timestamp = None
+        self.wakeup = threading.Event()
+        self.renderers = {}
+
+    def poll(self):
+        with metrics.timer('mydaikin_refresh_seconds'):
+            aircos, snapshots = shared_fleet(reuse=0)
+        if MY_METRICS_EXPORT:
+            metrics.export()
+        with self.lock:
+            self.aircos = aircos
+            self.snapshots = OrderedDict((host, unit._snapshot if unit is not None else None)
+                                         for host, unit in snapshots.items())
+            self.timestamp = time.time()
+
+    def poll_forever(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                log.debug("Daemon: poll failed: {}".format(e))
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def state(self):
+        with self.lock:
+            if self.snapshots is None:
+                return {'ok': False, 'error': 'not polled yet'}
+            return {'ok': True,
+                    'time': self.timestamp,
+                    'aircos': self.aircos,
+                    'snapshots': [(host, snapshot.to_dict() if snapshot is not None else None)
+                                  for host, snapshot in self.snapshots.items()]}
+
+    def menu(self, color, info_color):
+        with self.lock:
+            if self.snapshots is None:
+                return {'ok': False, 'error': 'not polled yet'}
+            renderer = self.renderers.setdefault((color, info_color), MenuRenderer(color, info_color))
+            snapshots = OrderedDict((host, Aircon.from_snapshot(snapshot) if snapshot is not None else None)
+                                    for host, snapshot in self.snapshots.items())
+            try:
+                return {'ok': True, 'menu': renderer.render(self.aircos, snapshots)}
+            except Exception as e:
+                return {'ok': True, 'menu': renderer.render_error()}
+
+    def applied(self, results):
+        '''Patch the snapshots of units with the state set by commands'''
+        with self.lock:
+            for host, result in results.items():
+                snapshot = (self.snapshots or {}).get(host)
+                if snapshot is not None and result.get('control_info') is not None:
+                    snapshot.control_info = parse_control_info(dict(result['control_info']))
+
+    def command(self, host, command, value):
+        result = run_command(host, command, value)
+        if result is None:
+            return {'ok': False, 'error': 'unknown command'}
+        self.applied({host: result})
+        return {'ok': True, 'results': {host: result}}
+
+    def scene(self, name):
+        with self.lock:
+            hosts = list(self.aircos.keys()) if self.aircos is not None else None
+        results = run_scene(name, hosts)
+        if results is None:
+            return {'ok': False, 'error': 'unknown scene'}
+        self.applied(results)
+        return {'ok': True, 'results': results}
+
+    def handle(self, request):
+        op = request.get('op')
+        if op == 'state':
+            return self.state()
+        elif op == 'menu':
+            return self.menu(request['color'], request['info_color'])
+        elif op == 'command':
+            return self.command(request['host'], request['command'], request['value'])
+        elif op == 'scene':
+            return self.scene(request['name'])
+        elif op == 'refresh':
+            self.wakeup.set()
+            return {'ok': True}
+        return {'ok': False, 'error': 'unknown op'}
+
+    def serve_forever(self):
+        '''Poll and serve until terminated
+
+           Returns False right away when another daemon answers on
+           the socket already. A socket left behind by a daemon that
+           did not exit cleanly is replaced.
+        '''
+        import signal
+        import socketserver
+
+        daemon = self
+
+        class UnixRequestHandler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                request = self.rfile.readline()
+                # A connection without request, e.g. from a daemon checking for this one
+                if not request:
+                    return
+                try:
+                    response = daemon.handle(json.loads(request.decode()))
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            sckt = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sckt.connect(self.path)
+                log.debug("Daemon: already serving on {}".format(self.path))
+                return False
+            except (IOError, OSError):
+                os.unlink(self.path)
+            finally:
+                sckt.close()
+
+        poller = threading.Thread(target=self.poll_forever)
+        poller.daemon = True
+        poller.start()
+
+        server = socketserver.ThreadingUnixStreamServer(self.path, UnixRequestHandler)
+        server.daemon_threads = True
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        log.debug("Daemon: serving on {}".format(self.path))
+        inode = os.stat(self.path).st_ino
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            # Unless another daemon replaced it meanwhile
+            if os.path.exists(self.path) and os.stat(self.path).st_ino == inode:
+                os.unlink(self.path)
+
+
+def daemon_request(request, path=MY_DAEMON_SOCKET, timeout=MY_DAEMON_TIMEOUT, idempotent=True):
+    '''Send a request to the daemon, returns None when it is not running
+
+       Requests that are not idempotent, i.e. commands, may have been
+       carried out when the daemon does not answer in time, so they
+       only return None when the daemon could not be reached, and an
+       error otherwise.
+    '''
+    sent = False
+    try:
+        sckt = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sckt.settimeout(timeout)
+        try:
+            sckt.connect(path)
+            sent = True
+            sckt.sendall(json.dumps(request).encode() + b'\n')
+            response = sckt.makefile('rb').readline()
+        finally:
+            sckt.close()
+        response = json.loads(response.decode())
+    except (IOError, OSError, ValueError) as e:
+        log.debug("Daemon: not available: {}".format(e))
+        if sent and not idempotent:
+            return {'ok': False, 'error': 'no answer from daemon: {}'.format(e)}
+        return None
+    if not response.get('ok'):
+        log.debug("Daemon: {}".format(response.get('error')))
+        return None
+    return response
+
+
+# Machine readable output: one record per unit, written as soon as the unit is polled
+
+UNIT_FIELDS = ['host', 'mac', 'name', 'firmware', 'online', 'offline_since', 'power', 'mode', 'target_temp',
+               'indoor_temp', 'outdoor_temp', 'frate', 'fdir']
+
+OUTPUT_FORMATS = ['ndjson', 'json', 'csv']
+
+
+def unit_record(host, info, unit):
+    '''State of a unit as a flat record of UNIT_FIELDS'''
+    record = OrderedDict((field, None) for field in UNIT_FIELDS)
+    record['host'] = host
+    if unit is None:
+        record.update({'mac': info.get('mac'), 'name': decode_name(info.get('name', host)),
+                       'online': False, 'offline_since': info.get('offline_since')})
+        return record
+    record.update({'mac': unit.get_mac_address(), 'name': unit.get_name(), 'firmware': unit.get_firmware_version(),
+                   'online': True, 'power': unit.get_power(), 'mode': unit.get_mode(),
+                   'target_temp': unit.get_target_temp(), 'indoor_temp': unit.get_indoor_temp(),
+                   'outdoor_temp': unit.get_outdoor_temp(), 'frate': unit.get_frate(), 'fdir': unit.get_fdir()})
+    return record
+
+
+def iter_records(watch=False, interval=MY_WATCH_INTERVAL):
+    '''Yield the record of every unit as it is polled
+
+       With watch, keep polling every interval seconds, and after the
+       first poll only yield the host, the time and the fields that
+       changed of units that changed. Units are polled by a thread that
+       holds refresh.lock only while polling, see `shared_fleet`, so a
+       slow reader of the records never holds up other processes.
+    '''
+    import queue
+
+    previous = {}
+    while True:
+        polled = queue.Queue()
+        def poll():
+            try:
+                with cache_lock('refresh.lock', timeout=2 * MY_REFRESH_DEADLINE):
+                    for item in iter_fleet():
+                        polled.put(item)
+            except Exception as e:
+                polled.put(e)
+            finally:
+                polled.put(None)
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.start()
+        for item in iter(polled.get, None):
+            if isinstance(item, Exception):
+                raise item
+            host, info, unit = item
+            record = unit_record(host, info, unit)
+            if watch:
+                changed = OrderedDict((field, value) for field, value in record.items()
+                                      if host not in previous or previous[host].get(field) != value)
+                previous[host] = record
+                if len(changed) == 0:
+                    continue
+                record = OrderedDict([('host', host), ('time', time.time())])
+                record.update(changed)
+            yield record
+        if not watch:
+            return
+        time.sleep(interval)
+
+
+def write_records(records, fmt, fields=UNIT_FIELDS, out=None):
+    '''Write records one by one, flushing each, as ndjson, a json array or csv with the given fields'''
+    import csv
+
+    out = out or sys.stdout
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, fields, extrasaction='ignore')
+        writer.writeheader()
+    elif fmt == 'json':
+        out.write('[')
+    for count, record in enumerate(records):
+        if fmt == 'csv':
+            writer.writerow(record)
+        elif fmt == 'json':
+            out.write((',\n' if count > 0 else '\n') + json.dumps(record))
+        else:
+            out.write(json.dumps(record) + '\n')
+        out.flush()
+    if fmt == 'json':
+        out.write('\n]\n')
+        out.flush()
+
+
+# Menu rendering
+
+MENU_RMODES = OrderedDict([ ('0','Auto'), ('3','Cooling'), ('4','Heating'), ('6','Ventilating'), ('2','Drying'), ('1','Auto - cooling'), ('7','Auto - heating') ])
+MENU_MODES = OrderedDict([ ('auto','0'), ('cool','3'), ('heat','4'), ('fan','6'), ('dry','2') ])
+MENU_FRATES = OrderedDict([ ('auto','A'), ('silent','B'), ('1','3'), ('2','4'), ('3','5'), ('4','6'), ('5','7') ])
+MENU_FDIRS = OrderedDict([ ('none','0'), ('vertical','1'), ('horizontal','2'), ('3D','3') ])
+
+
+class MenuRenderer():
+    '''Renders the xbar menu
+
+       The submenus of a unit only depend on its IP, its capabilities
+       and the temperatures offered, so they are formatted once per IP,
+       capabilities and temperatures as templates in which only the
+       color of the selected option is filled in. The rendered block of every
+       unit is cached together with the state it was rendered from,
+       so unchanged units are emitted from cache by long-lived
+       renderers, e.g. the daemon's. The whole menu is returned as a
+       single string, to be written at once.
+    '''
+
+    def __init__(self, color, info_color, prefix=''):
+        self.color = color
+        self.info_color = info_color
+        self.prefix = prefix
+        self.templates = {}
+        self.units = {}
+
+    def option(self, depth, label, airco, command, value, alternate):
+        if alternate:
+            return u'%s%s%s | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=' % (self.prefix, depth, label, cmd_path, airco, command, value)
+        return u'%s%s%s | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=' % (self.prefix, depth, label, cmd_path, airco, command, value)
+
+    def template(self, airco, capabilities, mode, stemp):
+        '''Submenu options of a unit: (group, value, visible line, alternate line)'''
+        temperatures = OrderedDict(('%s°C' % t, t) for t in capabilities.temperatures(mode, stemp))
+        key = (airco, capabilities.key(), tuple(temperatures.values()))
+        if key not in self.templates:
+            options = []
+            for group, depth, command, choices, supported in [('mode', '----', 'set_mode', MENU_MODES, capabilities.modes),
+                                                              ('stemp', '----', 'set_target_temp', temperatures, temperatures.values()),
+                                                              ('f_rate', '------', 'set_frate', MENU_FRATES, capabilities.frates),
+                                                              ('f_dir', '------', 'set_fdir', MENU_FDIRS, capabilities.fdirs)]:
+                for label, value in choices.items():
+                    if value not in supported:
+                        continue
+                    options.append((group, value,
+                                    self.option(depth, label, airco, command, value, False),
+                                    self.option(depth, label, airco, command, value, True)))
+            power = {value: (self.option('--', label, airco, 'set_power', value, False) + self.color + '\n' +
+                             self.option('--', label, airco, 'set_power', value, True) + self.color + '\n')
+                     for label, value in [('Turn off', 0), ('Turn on', 1)]}
+            self.templates[key] = (options, power)
+        return self.templates[key]
+
+    def render(self, aircos, snapshots):
+        polled = [unit for unit in snapshots.values() if unit is not None]
+
+        if (len(aircos) == 0):
+           raise Exception("No units discovered")
+
+        out = [app_logo()]
+        if (len(polled) > 0):
+           out.append(u'%sOutside: \t\t\t%s°C | color=%s\n' % (self.prefix, polled[0].get_outdoor_temp(), self.color))
+        else:
+           out.append(u'%sOutside: \t\t\t- | color=%s\n' % (self.prefix, self.info_color))
+        out.append(self.render_energy(aircos, snapshots))
+        out.append('%s---\n' % self.prefix)
+
+        capabilities = CapabilityCache()
+        for airco, airco_unit in snapshots.items():
+           try:
+              if airco_unit is None:
+                 out.append(self.render_offline(airco, aircos[airco]))
+              else:
+                 out.append(self.render_unit(airco, airco_unit, capabilities.get(airco_unit.get_mac_address(), airco_unit.get_firmware_version())))
+           except Exception as e:
+              log.debug("Menu: failed to render {}: {}".format(airco, e))
+              out.append(self.render_offline(airco, {'name': aircos[airco].get('name', airco)}))
+
+        if (len(MY_SCENES) > 0):
+           out.append('%s---\n%sScenes | color=%s\n' % (self.prefix, self.prefix, self.color))
+           for name in MY_SCENES.keys():
+              out.append(u'%s--%s | refresh=true terminal=false shell="%s" param1=--scene param2="%s" color=%s\n' % (self.prefix, name, cmd_path, name, self.color))
+
+        out.append('%s---\n' % self.prefix)
+        out.append('%sRefreshed with %s requests | color=%s\n' % (self.prefix, sum(unit.requests for unit in polled), self.info_color))
+        return ''.join(out)
+
+    def render_energy(self, aircos, snapshots):
+        macs = OrderedDict((aircos[airco].get('mac'), airco) for airco in snapshots.keys())
+        try:
+           summary = EnergyStats().summary(macs.keys())
+        except (KeyError, TypeError, ValueError) as e:
+           log.debug("Menu: failed to summarize energy: {}".format(e))
+           summary = None
+        if summary is None:
+           return ''
+
+        def kwh(value):
+           if MY_ENERGY_PRICE is None:
+              return u'%.1f kWh' % value
+           return u'%.1f kWh (%s%.2f)' % (value, MY_ENERGY_CURRENCY, value * MY_ENERGY_PRICE)
+
+        totals, units = summary
+        prefix, color, info_color = self.prefix, self.color, self.info_color
+        out = [u'%sEnergy today: \t\t%s | color=%s\n' % (prefix, kwh(totals['today']), color)]
+        for label, period in [('Last 7 days', 'week'), ('This month', 'month'), ('This year', 'year')]:
+           out.append(u'%s--%s: %s | color=%s\n' % (prefix, label, kwh(totals[period]), info_color))
+        out.append(u'%s-----\n' % prefix)
+        for mac, today in units.items():
+           airco_name = decode_name(aircos[macs[mac]].get('name', macs[mac]))
+           out.append(u'%s--%s: %s | color=%s\n' % (prefix, airco_name, kwh(today), info_color))
+        return ''.join(out)
+
+    def render_offline(self, airco, info):
+        airco_name = decode_name(info.get('name', airco))
+        since = info.get('offline_since')
+        last_known = info.get('last_known')
+        if since is None:
+           return u'%s%s %sstale/unreachable%s | color=%s\n' % (self.prefix, justify(airco_name,18), CYELLOW, CEND, self.info_color)
+        since = datetime.fromtimestamp(since)
+        since = since.strftime('%H:%M' if since.date() == date.today() else '%d/%m %H:%M')
+        if last_known is None or last_known['sensor_info'].get('htemp') is None:
+           return u'%s%s %soffline since %s%s | color=%s\n' % (self.prefix, justify(airco_name,18), CYELLOW, since, CEND, self.info_color)
+        return u'%s%s %s°C %soffline since %s%s | color=%s\n' % (self.prefix, justify(airco_name,18), last_known['sensor_info']['htemp'], CYELLOW, since, CEND, self.info_color)
+
+    def render_error(self):
+        return app_logo() + '%sNo Daikin airco detected | color=%s\n' % (self.prefix, self.color)
+
+    def render_unit(self, airco, airco_unit, capabilities):
+        airco_name     = airco_unit.get_name()
+        airco_power    = airco_unit.get_power()
+        airco_temp_cur = airco_unit.get_indoor_temp()
+        airco_temp_tar = airco_unit.get_target_temp()
+        airco_mode     = airco_unit.get_mode()
+        airco_frate    = airco_unit.get_frate()
+        airco_fdir     = airco_unit.get_fdir()
+
+        try:
+           history = UnitHistory(airco_unit.get_mac_address())
+           try:
+              airco_today = history.today()
+              airco_trend = tuple(history.trend())
+           finally:
+              history.close()
+        except (IOError, OSError, KeyError):
+           airco_today, airco_trend = None, ()
+
+        state = (airco_name, airco_power, airco_temp_cur, airco_temp_tar, airco_mode, airco_frate, airco_fdir, airco_today, airco_trend, capabilities.key())
+        cached = self.units.get(airco)
+        if cached is not None and cached[0] == state:
+           return cached[1]
+
+        prefix, color, info_color = self.prefix, self.color, self.info_color
+        options, power = self.template(airco, capabilities, airco_mode, airco_temp_tar)
+        out = []
+
+        if bool(airco_power):
+           if (airco_temp_tar == None):
+              out.append(u'%s%s %s°C %s(%s)%s| color=%s\n' % (prefix, justify(airco_name,18), airco_temp_cur, CGREEN, MENU_RMODES[str(airco_mode)], CEND, color))
+           elif (airco_temp_tar == 'M'):
+              out.append(u'%s%s %s°C %s(%s)%s| color=%s\n' % (prefix, justify(airco_name,18), airco_temp_cur, CGREEN, MENU_RMODES[str(airco_mode)], CEND, color))
+           elif (airco_temp_cur >= airco_temp_tar):
+              out.append(u'%s%s %s°C %s-> %s°C%s (%s)| color=%s\n' % (prefix, justify(airco_name,18), airco_temp_cur, CBLUE, airco_temp_tar, CEND, MENU_RMODES[str(airco_mode)], color))
+           else:
+              out.append(u'%s%s %s°C %s-> %s°C%s (%s)| color=%s\n' % (prefix, justify(airco_name,18), airco_temp_cur, CRED, airco_temp_tar, CEND, MENU_RMODES[str(airco_mode)], color))
+           out.append(power[0])
+        else:
+           out.append(u'%s%s %s°C | color=%s\n' % (prefix, justify(airco_name,18), airco_temp_cur, color))
+           out.append(power[1])
+
+        if (airco_today is not None):
+           out.append(u'%s--Today: %s°C - %s°C | color=%s\n' % (prefix, airco_today[0], airco_today[1], info_color))
+        if (len(airco_trend) > 1):
+           out.append(u'%s--Last 24h: %s | color=%s font=Menlo\n' % (prefix, sparkline(airco_trend), info_color))
+
+        selected = {'mode': str(airco_mode), 'stemp': str(airco_temp_tar), 'f_rate': str(airco_frate), 'f_dir': str(airco_fdir)}
+        headings = {'mode': '%s-----\n%s--Mode | color=%s\n' % (prefix, prefix, color),
+                    'stemp': '%s--Temperature | color=%s\n' % (prefix, color),
+                    'f_rate': '%s--Fan | color=%s\n%s----Rate | color=%s\n' % (prefix, color, prefix, color),
+                    'f_dir': '%s----Direction | color=%s\n' % (prefix, color)}
+        group = None
+        for option_group, value, visible, alternate in options:
+           if option_group != group:
+              group = option_group
+              out.append(headings[group])
+           option_color = color if value == selected[group] else info_color
+           out.append(visible + option_color + '\n' + alternate + option_color + '\n')
+
+        text = ''.join(out)
+        self.units[airco] = (state, text)
+        return text
+
+
+# Startup measurement: lazily imported modules of every entry path
+
+STARTUP_MODULES = OrderedDict([('requests to units', ['urllib3']),
+                               ('discovery', ['asyncio', 'ipaddress', 're', 'subprocess']),
+                               ('polling', ['queue']),
+                               ('unit names', ['urllib.parse']),
+                               ('history', ['mmap']),
+                               ('daemon', ['socketserver', 'signal']),
+                               ('csv output', ['csv'])])
+
+
+def startup_report():
+    '''Cost of every startup phase, of the lazy imports and of initialization'''
+    import importlib
+
+    # The script is compiled before it runs, on every run as it has no cached bytecode
+    with open(__file__, 'rb') as f:
+        source = f.read()
+    start = time.process_time()
+    compile(source, __file__, 'exec')
+    compiled = time.process_time() - start
+    lines = ['Startup breakdown',
+             '  {:<34} {:8.1f} ms'.format('interpreter (cpu)', max(0.0, STARTUP_CPU - compiled) * 1000),
+             '  {:<34} {:8.1f} ms'.format('compile script (cpu)', compiled * 1000)]
+    for (previous, start), (phase, end) in zip(STARTUP_TIMES, STARTUP_TIMES[1:]):
+        lines.append('  {:<34} {:8.1f} ms'.format(phase, (end - start) * 1000))
+    lines.append('Lazy imports')
+    for path, modules in STARTUP_MODULES.items():
+        start = time.perf_counter()
+        for module in modules:
+            importlib.import_module(module)
+        lines.append('  {:<34} {:8.1f} ms  {}'.format(path, (time.perf_counter() - start) * 1000, ' '.join(modules)))
+    lines.append('Initialization')
+    for phase, function in [('load caches', lambda: (load_host_cache(), PollSchedule(), UnitHealth(), EnergyStats())),
+                            ('daemon request', lambda: daemon_request({'op': 'state'}))]:
+        start = time.perf_counter()
+        function()
+        lines.append('  {:<34} {:8.1f} ms'.format(phase, (time.perf_counter() - start) * 1000))
+    return '\n'.join(lines) + '\n'
 
-    return discovered
 
 # Logo for both dark mode and regular mode
-def app_print_logo():
+def app_logo():
     if bool(DARK_MODE):
-        print ('|image=iVBORw0KGgoAAAANSUhEUgAAACQAAAAkCAYAAADhAJiYAAAABGdBTUEAALGPC/xhBQAAACBjSFJNAAB6JgAAgIQAAPoAAACA6AAAdTAAAOpgAAA6mAAAF3CculE8AAAAhGVYSWZNTQAqAAAACAAFARIAAwAAAAEAAQAAARoABQAAAAEAAABKARsABQAAAAEAAABSASgAAwAAAAEAAgAAh2kABAAAAAEAAABaAAAAAAAAAJAAAAABAAAAkAAAAAEAA6ABAAMAAAABAAEAAKACAAQAAAABAAAAJKADAAQAAAABAAAAJAAAAAA4NgJpAAAACXBIWXMAABYlAAAWJQFJUiTwAAACaGlUWHRYTUw6Y29tLmFkb2JlLnhtcAAAAAAAPHg6eG1wbWV0YSB4bWxuczp4PSJhZG9iZTpuczptZXRhLyIgeDp4bXB0az0iWE1QIENvcmUgNS40LjAiPgogICA8cmRmOlJERiB4bWxuczpyZGY9Imh0dHA6Ly93d3cudzMub3JnLzE5OTkvMDIvMjItcmRmLXN5bnRheC1ucyMiPgogICAgICA8cmRmOkRlc2NyaXB0aW9uIHJkZjphYm91dD0iIgogICAgICAgICAgICB4bWxuczp0aWZmPSJodHRwOi8vbnMuYWRvYmUuY29tL3RpZmYvMS4wLyIKICAgICAgICAgICAgeG1sbnM6ZXhpZj0iaHR0cDovL25zLmFkb2JlLmNvbS9leGlmLzEuMC8iPgogICAgICAgICA8dGlmZjpPcmllbnRhdGlvbj4xPC90aWZmOk9yaWVudGF0aW9uPgogICAgICAgICA8dGlmZjpSZXNvbHV0aW9uVW5pdD4yPC90aWZmOlJlc29sdXRpb25Vbml0PgogICAgICAgICA8ZXhpZjpDb2xvclNwYWNlPjE8L2V4aWY6Q29sb3JTcGFjZT4KICAgICAgICAgPGV4aWY6UGl4ZWxYRGltZW5zaW9uPjEyODwvZXhpZjpQaXhlbFhEaW1lbnNpb24+CiAgICAgICAgIDxleGlmOlBpeGVsWURpbWVuc2lvbj4xMjg8L2V4aWY6UGl4ZWxZRGltZW5zaW9uPgogICAgICA8L3JkZjpEZXNjcmlwdGlvbj4KICAgPC9yZGY6UkRGPgo8L3g6eG1wbWV0YT4KeSe3kAAAA+dJREFUWAm9mEtrFEEQx7N5aHyAIhFEISiIOYpCED1I0JMHQVCEoJBDPoAH8aZ4iCe/gYJ6EjyJXrxpvPi6SlBRkkCI+ICAeZgYTbL+/p2uoXe2d3ZnM0nBP9VTVV1VXdVTu5uWlhxULpfbYubIS0JMt24yArbKOfwUeAJGwEswaEFZb0xSBHKVgV8FMXq0YUkR3ZJRZYwesOgHQ2AaiG74CrZbcuvCCWQJPXVhy+X7YSBkg14+Cd/uk2pl3RZBOzLX+tBHU2sc6c6ILvmg2zw/uCp2fw95WeZdwrKmvpnyuooR+J+CQ7ETdxC0F90mUJYRJN4BJkul0iclBZlOekfNJFTlxJzBzd8t1tcCecWSZA6TzHt4G3w5VJqDUFZrXbPMwQZLdhTZPPgNrIJWoR/IfgGR2a8+8TdPQsmmjIU7Lae+w+k1CuQ/DKrkZtD/9S1bSfsqOqEkOEGn08EaeS46IRsRfQS/DqwCarfWuuTj4AoJz/oqJYdAXnjL7L4M4Pu0AkSoD9ld8BbIvulLzd66ZM5vYjkGVDGrgPhm8AW8Ay1Uyez16KjolrkWEWgC70M+Ri5WdEJuNHA3VInjQIMwrJANRk198i5mMGad2A6o6qz7YMxKxHRWjVEEscGohH+CtQ1Gldci1uEuIVqhwfgQ23TLdMmn0S/7ltlYSNxaiRNBesHGVhyswJe8zqpgpuHzgoTY6jNqzgzS3CcT7ktMbG4kgnDhHSuZ3ci7vE6nFlnVdGqjHr/Q9yH3PTvGSTaajDmJchy5ZOFd4CMwOq8NPGjqineDJa+ch5/08rrVl11DhNPkVwTrFz7YDPyiHEif4keQffB2U/A9Xp/ZAdk0RDh0p4MPANEisJNXBEFuldzJ+jMQ3VMg+NqrhJOwOq/kHbrtA2jgVRF6J4eflTGkD869MoRXHKBqcz2BOYDvBwtAdNQ7Dy9w4gq9tbCT9Zg2QBf8nlxVimVvb88+HHYCDbEJOYeq5oaEemsgjYc/PI5LBh1YZfn+xhIyD6ZTgnlOaVU0bv4a4hY0NLYZ8RXhItgBur1BzN69dVRH82ordlYZq5Tf2iTDaXipX6sXkF1qtbCK0Kcv9RwytXztl9o7sdf+srKBdLl7Tcdav0ANbnLzvAXYj0l9I1QyeVqtLbUJZ+5yw/WfDtF3cCa2A3kPeANEE2CX7ODRFsd8mMwFtYeQy5m/F2rTc3DC67UeBt+A7tcxcA6obVOgj32qVDvcPpARF0A4dW+KkgP6SpFFwyjd5Yc33aqaFbLz4NxVSs+sNSD7ge6TvgHMghHwmGo8g7t7U3hl5DgkEtGblzlXGrEJfdZa/wedKCidZn5clQAAAABJRU5ErkJggg==')
+        logo = ('|image=iVBORw0KGgoAAAANSUhEUgAAACQAAAAkCAYAAADhAJiYAAAABGdBTUEAALGPC/xhBQAAACBjSFJNAAB6JgAAgIQAAPoAAACA6AAAdTAAAOpgAAA6mAAAF3CculE8AAAAhGVYSWZNTQAqAAAACAAFARIAAwAAAAEAAQAAARoABQAAAAEAAABKARsABQAAAAEAAABSASgAAwAAAAEAAgAAh2kABAAAAAEAAABaAAAAAAAAAJAAAAABAAAAkAAAAAEAA6ABAAMAAAABAAEAAKACAAQAAAABAAAAJKADAAQAAAABAAAAJAAAAAA4NgJpAAAACXBIWXMAABYlAAAWJQFJUiTwAAACaGlUWHRYTUw6Y29tLmFkb2JlLnhtcAAAAAAAPHg6eG1wbWV0YSB4bWxuczp4PSJhZG9iZTpuczptZXRhLyIgeDp4bXB0az0iWE1QIENvcmUgNS40LjAiPgogICA8cmRmOlJERiB4bWxuczpyZGY9Imh0dHA6Ly93d3cudzMub3JnLzE5OTkvMDIvMjItcmRmLXN5bnRheC1ucyMiPgogICAgICA8cmRmOkRlc2NyaXB0aW9uIHJkZjphYm91dD0iIgogICAgICAgICAgICB4bWxuczp0aWZmPSJodHRwOi8vbnMuYWRvYmUuY29tL3RpZmYvMS4wLyIKICAgICAgICAgICAgeG1sbnM6ZXhpZj0iaHR0cDovL25zLmFkb2JlLmNvbS9leGlmLzEuMC8iPgogICAgICAgICA8dGlmZjpPcmllbnRhdGlvbj4xPC90aWZmOk9yaWVudGF0aW9uPgogICAgICAgICA8dGlmZjpSZXNvbHV0aW9uVW5pdD4yPC90aWZmOlJlc29sdXRpb25Vbml0PgogICAgICAgICA8ZXhpZjpDb2xvclNwYWNlPjE8L2V4aWY6Q29sb3JTcGFjZT4KICAgICAgICAgPGV4aWY6UGl4ZWxYRGltZW5zaW9uPjEyODwvZXhpZjpQaXhlbFhEaW1lbnNpb24+CiAgICAgICAgIDxleGlmOlBpeGVsWURpbWVuc2lvbj4xMjg8L2V4aWY6UGl4ZWxZRGltZW5zaW9uPgogICAgICA8L3JkZjpEZXNjcmlwdGlvbj4KICAgPC9yZGY6UkRGPgo8L3g6eG1wbWV0YT4KeSe3kAAAA+dJREFUWAm9mEtrFEEQx7N5aHyAIhFEISiIOYpCED1I0JMHQVCEoJBDPoAH8aZ4iCe/gYJ6EjyJXrxpvPi6SlBRkkCI+ICAeZgYTbL+/p2uoXe2d3ZnM0nBP9VTVV1VXdVTu5uWlhxULpfbYubIS0JMt24yArbKOfwUeAJGwEswaEFZb0xSBHKVgV8FMXq0YUkR3ZJRZYwesOgHQ2AaiG74CrZbcuvCCWQJPXVhy+X7YSBkg14+Cd/uk2pl3RZBOzLX+tBHU2sc6c6ILvmg2zw/uCp2fw95WeZdwrKmvpnyuooR+J+CQ7ETdxC0F90mUJYRJN4BJkul0iclBZlOekfNJFTlxJzBzd8t1tcCecWSZA6TzHt4G3w5VJqDUFZrXbPMwQZLdhTZPPgNrIJWoR/IfgGR2a8+8TdPQsmmjIU7Lae+w+k1CuQ/DKrkZtD/9S1bSfsqOqEkOEGn08EaeS46IRsRfQS/DqwCarfWuuTj4AoJz/oqJYdAXnjL7L4M4Pu0AkSoD9ld8BbIvulLzd66ZM5vYjkGVDGrgPhm8AW8Ay1Uyez16KjolrkWEWgC70M+Ri5WdEJuNHA3VInjQIMwrJANRk198i5mMGad2A6o6qz7YMxKxHRWjVEEscGohH+CtQ1Gldci1uEuIVqhwfgQ23TLdMmn0S/7ltlYSNxaiRNBesHGVhyswJe8zqpgpuHzgoTY6jNqzgzS3CcT7ktMbG4kgnDhHSuZ3ci7vE6nFlnVdGqjHr/Q9yH3PTvGSTaajDmJchy5ZOFd4CMwOq8NPGjqineDJa+ch5/08rrVl11DhNPkVwTrFz7YDPyiHEif4keQffB2U/A9Xp/ZAdk0RDh0p4MPANEisJNXBEFuldzJ+jMQ3VMg+NqrhJOwOq/kHbrtA2jgVRF6J4eflTGkD869MoRXHKBqcz2BOYDvBwtAdNQ7Dy9w4gq9tbCT9Zg2QBf8nlxVimVvb88+HHYCDbEJOYeq5oaEemsgjYc/PI5LBh1YZfn+xhIyD6ZTgnlOaVU0bv4a4hY0NLYZ8RXhItgBur1BzN69dVRH82ordlYZq5Tf2iTDaXipX6sXkF1qtbCK0Kcv9RwytXztl9o7sdf+srKBdLl7Tcdav0ANbnLzvAXYj0l9I1QyeVqtLbUJZ+5yw/WfDtF3cCa2A3kPeANEE2CX7ODRFsd8mMwFtYeQy5m/F2rTc3DC67UeBt+A7tcxcA6obVOgj32qVDvcPpARF0A4dW+KkgP6SpFFwyjd5Yc33aqaFbLz4NxVSs+sNSD7ge6TvgHMghHwmGo8g7t7U3hl5DgkEtGblzlXGrEJfdZa/wedKCidZn5clQAAAABJRU5ErkJggg==')
     else:
-        print ('|image=iVBORw0KGgoAAAANSUhEUgAAACQAAAAkCAYAAADhAJiYAAAABGdBTUEAALGPC/xhBQAAACBjSFJNAAB6JgAAgIQAAPoAAACA6AAAdTAAAOpgAAA6mAAAF3CculE8AAAAeGVYSWZNTQAqAAAACAAFARIAAwAAAAEAAQAAARoABQAAAAEAAABKARsABQAAAAEAAABSASgAAwAAAAEAAgAAh2kABAAAAAEAAABaAAAAAAAAAJAAAAABAAAAkAAAAAEAAqACAAQAAAABAAAAJKADAAQAAAABAAAAJAAAAACP5Tu0AAAACXBIWXMAABYlAAAWJQFJUiTwAAACZmlUWHRYTUw6Y29tLmFkb2JlLnhtcAAAAAAAPHg6eG1wbWV0YSB4bWxuczp4PSJhZG9iZTpuczptZXRhLyIgeDp4bXB0az0iWE1QIENvcmUgNS40LjAiPgogICA8cmRmOlJERiB4bWxuczpyZGY9Imh0dHA6Ly93d3cudzMub3JnLzE5OTkvMDIvMjItcmRmLXN5bnRheC1ucyMiPgogICAgICA8cmRmOkRlc2NyaXB0aW9uIHJkZjphYm91dD0iIgogICAgICAgICAgICB4bWxuczp0aWZmPSJodHRwOi8vbnMuYWRvYmUuY29tL3RpZmYvMS4wLyIKICAgICAgICAgICAgeG1sbnM6ZXhpZj0iaHR0cDovL25zLmFkb2JlLmNvbS9leGlmLzEuMC8iPgogICAgICAgICA8dGlmZjpPcmllbnRhdGlvbj4xPC90aWZmOk9yaWVudGF0aW9uPgogICAgICAgICA8dGlmZjpSZXNvbHV0aW9uVW5pdD4yPC90aWZmOlJlc29sdXRpb25Vbml0PgogICAgICAgICA8ZXhpZjpDb2xvclNwYWNlPjE8L2V4aWY6Q29sb3JTcGFjZT4KICAgICAgICAgPGV4aWY6UGl4ZWxYRGltZW5zaW9uPjM2PC9leGlmOlBpeGVsWERpbWVuc2lvbj4KICAgICAgICAgPGV4aWY6UGl4ZWxZRGltZW5zaW9uPjM2PC9leGlmOlBpeGVsWURpbWVuc2lvbj4KICAgICAgPC9yZGY6RGVzY3JpcHRpb24+CiAgIDwvcmRmOlJERj4KPC94OnhtcG1ldGE+ChVabI0AAAOYSURBVFgJvZbJa1RBEMbjvoIiCqIQFETBiygEl4MEbx4EQRGCiof8AR7Em+IhnvwPFExOgieJF28uFxWvEheUJBAUFxDcd6Pfb7q/5M3YL/PezJsUfF3d1dVV1dU19aarqxzNy1GfIzmYVZobve0THxZGhDtCv2CataCcmVPy/DeBq45IvONBORgy42CGNO8TBoQPUX5WHJofWOdGB3RdLghosMFVf5S/EF8e93hezjWCYP30UbV1Rs0Q0NFoYlnkm6Kcvc1R1uzZcvdbSa8z9is6T914gfZ6hIUCgUJw5GTyqUBQ3tM0UCsB/WfExsRt77zmpzPyxuk2CR4KXO5PdtMGsrK8eW6aMwcc7KhkX4UvgjPoDL2R7L0AWT+sNJYJaOrQDBPf9qJ0aAXYzzoluI/CT4ELTgp1VHVAWee0g9JUdUAu+F5FckZwBpwNinxcOCl8EpKFLXkheiQtMnA8amMc4qeOHGwVoCHBshTfVdMKRR2ngVWdIdfQOZkfE8gYAUHwRcJz4YEAWT+sNFYdkJ9oQrYHpryUmFQdkFsDmdgt0AizGXJjpOsn66fqgGyP7HS8McpHU3I2RqWZaowE/FZouzH6KZpF5IBojFeExiejyOlPFDM2XXOaBnKKvU5xuisHf8dNO7Vudv0tCnH82QoJnqwf9PydSZypiTBMMGuE1TVJuDVTZw0d05Y4wS77echewmebcgdLIE8EjIBDAuTG2K052WOPutkrQEWyHzQLjL4ZqrcEnPFRPCJAzo75dskeC+i9E9YKkC8VVm2Mvt0J2cDJD8E3b3Ti9UrpPIv6l8Uh2wmrFsdsdu7KBgFdiLZoeCmy/IA20efDuS4qOuC4LM9sYIOO8qvBwQ4ByhZwkITRT7dYyzGBM4fDVrks2Xk8W2M2vl4rHNDEJmo7ib4R5QSAre/CeJRtjLwUSwVkA94jwDK14Cya214hbqdZZW4LvRQo5hVCtwCl9JET9KSwVHBmnCmJ2iOMA+ieQIAuap4wRY1FTZfmyaG8S4TdgqOf6Jj0CYji7oln2cuC7xW0RBgR0L8kQLYTVm2OztKw7ODktbA/xyafjPsCehPCKgEqnR07DcfrR4xRFzzTTWGPADG/LbwSqK+dwkGBZ6NL9wpkiuz4g6xpNeRfCsHxl4IM5IEgXfwtP9VMGZL9GjlTLGiQfQL1xD8AOjLZuCbcEKCOZCaYnh4J3NmaltbPiujUn0is/gHL2rqV+yXGhgAAAABJRU5ErkJggg==')
-    print('---')
+        logo = ('|image=iVBORw0KGgoAAAANSUhEUgAAACQAAAAkCAYAAADhAJiYAAAABGdBTUEAALGPC/xhBQAAACBjSFJNAAB6JgAAgIQAAPoAAACA6AAAdTAAAOpgAAA6mAAAF3CculE8AAAAeGVYSWZNTQAqAAAACAAFARIAAwAAAAEAAQAAARoABQAAAAEAAABKARsABQAAAAEAAABSASgAAwAAAAEAAgAAh2kABAAAAAEAAABaAAAAAAAAAJAAAAABAAAAkAAAAAEAAqACAAQAAAABAAAAJKADAAQAAAABAAAAJAAAAACP5Tu0AAAACXBIWXMAABYlAAAWJQFJUiTwAAACZmlUWHRYTUw6Y29tLmFkb2JlLnhtcAAAAAAAPHg6eG1wbWV0YSB4bWxuczp4PSJhZG9iZTpuczptZXRhLyIgeDp4bXB0az0iWE1QIENvcmUgNS40LjAiPgogICA8cmRmOlJERiB4bWxuczpyZGY9Imh0dHA6Ly93d3cudzMub3JnLzE5OTkvMDIvMjItcmRmLXN5bnRheC1ucyMiPgogICAgICA8cmRmOkRlc2NyaXB0aW9uIHJkZjphYm91dD0iIgogICAgICAgICAgICB4bWxuczp0aWZmPSJodHRwOi8vbnMuYWRvYmUuY29tL3RpZmYvMS4wLyIKICAgICAgICAgICAgeG1sbnM6ZXhpZj0iaHR0cDovL25zLmFkb2JlLmNvbS9leGlmLzEuMC8iPgogICAgICAgICA8dGlmZjpPcmllbnRhdGlvbj4xPC90aWZmOk9yaWVudGF0aW9uPgogICAgICAgICA8dGlmZjpSZXNvbHV0aW9uVW5pdD4yPC90aWZmOlJlc29sdXRpb25Vbml0PgogICAgICAgICA8ZXhpZjpDb2xvclNwYWNlPjE8L2V4aWY6Q29sb3JTcGFjZT4KICAgICAgICAgPGV4aWY6UGl4ZWxYRGltZW5zaW9uPjM2PC9leGlmOlBpeGVsWERpbWVuc2lvbj4KICAgICAgICAgPGV4aWY6UGl4ZWxZRGltZW5zaW9uPjM2PC9leGlmOlBpeGVsWURpbWVuc2lvbj4KICAgICAgPC9yZGY6RGVzY3JpcHRpb24+CiAgIDwvcmRmOlJERj4KPC94OnhtcG1ldGE+ChVabI0AAAOYSURBVFgJvZbJa1RBEMbjvoIiCqIQFETBiygEl4MEbx4EQRGCiof8AR7Em+IhnvwPFExOgieJF28uFxWvEheUJBAUFxDcd6Pfb7q/5M3YL/PezJsUfF3d1dVV1dU19aarqxzNy1GfIzmYVZobve0THxZGhDtCv2CataCcmVPy/DeBq45IvONBORgy42CGNO8TBoQPUX5WHJofWOdGB3RdLghosMFVf5S/EF8e93hezjWCYP30UbV1Rs0Q0NFoYlnkm6Kcvc1R1uzZcvdbSa8z9is6T914gfZ6hIUCgUJw5GTyqUBQ3tM0UCsB/WfExsRt77zmpzPyxuk2CR4KXO5PdtMGsrK8eW6aMwcc7KhkX4UvgjPoDL2R7L0AWT+sNJYJaOrQDBPf9qJ0aAXYzzoluI/CT4ELTgp1VHVAWee0g9JUdUAu+F5FckZwBpwNinxcOCl8EpKFLXkheiQtMnA8amMc4qeOHGwVoCHBshTfVdMKRR2ngVWdIdfQOZkfE8gYAUHwRcJz4YEAWT+sNFYdkJ9oQrYHpryUmFQdkFsDmdgt0AizGXJjpOsn66fqgGyP7HS8McpHU3I2RqWZaowE/FZouzH6KZpF5IBojFeExiejyOlPFDM2XXOaBnKKvU5xuisHf8dNO7Vudv0tCnH82QoJnqwf9PydSZypiTBMMGuE1TVJuDVTZw0d05Y4wS77echewmebcgdLIE8EjIBDAuTG2K052WOPutkrQEWyHzQLjL4ZqrcEnPFRPCJAzo75dskeC+i9E9YKkC8VVm2Mvt0J2cDJD8E3b3Ti9UrpPIv6l8Uh2wmrFsdsdu7KBgFdiLZoeCmy/IA20efDuS4qOuC4LM9sYIOO8qvBwQ4ByhZwkITRT7dYyzGBM4fDVrks2Xk8W2M2vl4rHNDEJmo7ib4R5QSAre/CeJRtjLwUSwVkA94jwDK14Cya214hbqdZZW4LvRQo5hVCtwCl9JET9KSwVHBmnCmJ2iOMA+ieQIAuap4wRY1FTZfmyaG8S4TdgqOf6Jj0CYji7oln2cuC7xW0RBgR0L8kQLYTVm2OztKw7ODktbA/xyafjPsCehPCKgEqnR07DcfrR4xRFzzTTWGPADG/LbwSqK+dwkGBZ6NL9wpkiuz4g6xpNeRfCsHxl4IM5IEgXfwtP9VMGZL9GjlTLGiQfQL1xD8AOjLZuCbcEKCOZCaYnh4J3NmaltbPiujUn0is/gHL2rqV+yXGhgAAAABJRU5ErkJggg==')
+    return logo + '\n---\n'
+
+
+def app_print_logo():
+    sys.stdout.write(app_logo())
 
 
 # No init needed for Daikin
@@ -423,13 +2887,6 @@ def init():
 
 def main(argv):
 
-    # get the data for the location      
-    try:
-       aircos = discover()
-    except Exception as e:
-       aircos = {}
-
-
     if bool(DARK_MODE):                                                         
         color = '#FFFFFE'                                                       
         info_color = '#C0C0C0'                                                  
@@ -438,117 +2895,95 @@ def main(argv):
         info_color = '#616161'   
 
 
+    # CASE 0: machine readable output
+    #         form: --format ndjson|json|csv, and/or --watch to output changes
+    #         or --startup to measure the startup cost of every phase
+
+    if (len(argv) == 2) and (argv[1] == '--startup'):
+        sys.stdout.write(startup_report())
+        return
+
+    if (len(argv) > 1) and (argv[1] in ['--format', '--watch']):
+        watch = '--watch' in argv
+        fmt = argv[argv.index('--format') + 1] if '--format' in argv[:-1] else 'ndjson'
+        if (fmt not in OUTPUT_FORMATS) or (watch and fmt == 'json'):
+            print ("Unknown argument, try again.")
+            return
+        try:
+            write_records(iter_records(watch=watch), fmt,
+                          fields=['host', 'time'] + UNIT_FIELDS[1:] if watch else UNIT_FIELDS)
+        except KeyboardInterrupt:
+            pass
+        return
+
     # CASE 1: command received
     #         form: IP command arg
+    #         or --scene name to apply a scene to all units
+    #         or --daemon to start the resident agent
+    #         or --probe hosts to probe skipped units, see start_probes
 
-    if (len(argv) == 4):
-        target = Aircon(argv[1])
-        if (argv[2] == "set_power"):
-            if (argv[3] == '0'):
-               target.set_power(False)
-            else:
-               target.set_power(argv[3])
-        elif (argv[2] == "set_target_temp"):
-            target.set_target_temp(argv[3])
-        elif (argv[2] == "set_frate"):
-            target.set_frate(argv[3])
-        elif (argv[2] == "set_fdir"):
-            target.set_fdir(argv[3])
-        elif (argv[2] == "set_mode"):
-            target.set_mode(argv[3])
-        else: 
+    if (len(argv) == 2) and (argv[1] == '--daemon'):
+        if DaikinDaemon().serve_forever() is False:
+            print ("Daemon already running.")
+        return
+
+    if (len(argv) > 2) and (argv[1] == '--probe'):
+        record_probes(argv[2:])
+        return
+
+    if (len(argv) == 4) or ((len(argv) == 3) and (argv[1] == '--scene')):
+        if (len(argv) == 4):
+            request = {'op': 'command', 'host': argv[1], 'command': argv[2], 'value': argv[3]}
+        else:
+            request = {'op': 'scene', 'name': argv[2]}
+        # Long enough for a debounced read and write, as commands are not sent twice
+        response = daemon_request(request, timeout=MY_COMMAND_DEBOUNCE + 2 * MY_REFRESH_DEADLINE, idempotent=False)
+        if (response is not None) and (not response['ok']):
+            print (response['error'])
+            return
+        if response is not None:
+            results = response['results']
+        elif (len(argv) == 4):
+            result = run_command(argv[1], argv[2], argv[3])
+            results = {argv[1]: result} if result is not None else None
+        else:
+            results = run_scene(argv[2])
+        if results is None:
             print ("Unknown argument, try again.")
+            return
+        for host, result in results.items():
+            if not result['ok']:
+                print ("%s: %s" % (host, result['error']))
         return
 
     # CASE 2: bitbar output
+    #         or --profile for a timing breakdown of a single refresh
 
-    app_print_logo()
-    prefix = ''
-
-    # print the data for the location
-    # print ('%sNumber of aircos detected: %s | color=%s' % (prefix, len(aircos), color))
-    try:
-       base_unit = Aircon(list(aircos.keys())[0])
-       print (u'%sOutside: \t\t\t%s°C | color=%s' % (prefix, base_unit.get_outdoor_temp(), color))
-       print ('%s---' % prefix) 
-
-       for airco in aircos.keys():
-          airco_unit = Aircon(airco)
-
-          airco_name     = airco_unit.get_name()
-          airco_power    = airco_unit.get_power()
-          airco_temp_cur = airco_unit.get_indoor_temp()
-          airco_temp_tar = airco_unit.get_target_temp()
-          airco_mode     = airco_unit.get_mode()
-          airco_frate    = airco_unit.get_frate()
-          airco_fdir     = airco_unit.get_fdir()
-
-          rmodes = OrderedDict([ ('0','Auto'), ('3','Cooling'), ('4','Heating'), ('6','Ventilating'), ('2','Drying'), ('1','Auto - cooling'), ('7','Auto - heating') ])
-
-          if bool(airco_power):
-             if (airco_temp_tar == None):
-                print (u'%s%s %s°C %s(%s)%s| color=%s' % (prefix, justify(airco_name,18), airco_temp_cur, CGREEN, rmodes[str(airco_mode)], CEND, color))
-             elif (airco_temp_tar == 'M'):
-                print (u'%s%s %s°C %s(%s)%s| color=%s' % (prefix, justify(airco_name,18), airco_temp_cur, CGREEN, rmodes[str(airco_mode)], CEND, color))
-             elif (airco_temp_cur >= airco_temp_tar):
-                print (u'%s%s %s°C %s-> %s°C%s (%s)| color=%s' % (prefix, justify(airco_name,18), airco_temp_cur, CBLUE, airco_temp_tar, CEND, rmodes[str(airco_mode)], color))
-             else:
-                print (u'%s%s %s°C %s-> %s°C%s (%s)| color=%s' % (prefix, justify(airco_name,18), airco_temp_cur, CRED, airco_temp_tar, CEND, rmodes[str(airco_mode)], color))
-             print ('%s--Turn off | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, cmd_path, airco, 'set_power', 0, color))
-             print ('%s--Turn off | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, cmd_path, airco, 'set_power', 0, color))
-          else:
-             print (u'%s%s %s°C | color=%s' % (prefix, justify(airco_name,18), airco_temp_cur, color))
-             print ('%s--Turn on | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, cmd_path, airco, 'set_power', 1, color))
-             print ('%s--Turn on | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, cmd_path, airco, 'set_power', 1, color))
-
-
-          print ('%s-----' % prefix) 
-          print ('%s--Mode | color=%s' % (prefix, color))
-          modes = OrderedDict([ ('auto','0'), ('cool','3'), ('heat','4'), ('fan','6'), ('dry','2') ])
-          for mode in modes.keys():
-             if (modes[str(mode)] == str(airco_mode)):
-                print (u'%s----%s | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, mode, cmd_path, airco, 'set_mode', modes[str(mode)], color))
-                print (u'%s----%s | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, mode, cmd_path, airco, 'set_mode', modes[str(mode)], color))
-             else:
-                print (u'%s----%s | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, mode, cmd_path, airco, 'set_mode', modes[str(mode)], info_color))
-                print (u'%s----%s | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, mode, cmd_path, airco, 'set_mode', modes[str(mode)], info_color))
- 
-
-          print ('%s--Temperature | color=%s' % (prefix, color))
-          for temperature in ['18.0','19.0','20.0','21.0','22.0','23.0','24.0','25.0']:
-             if (str(temperature) == str(airco_temp_tar)):
-                print (u'%s----%s°C | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, temperature, cmd_path, airco, 'set_target_temp', temperature, color))
-                print (u'%s----%s°C | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, temperature, cmd_path, airco, 'set_target_temp', temperature, color))
-             else:
-                print (u'%s----%s°C | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, temperature, cmd_path, airco, 'set_target_temp', temperature, info_color))
-                print (u'%s----%s°C | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, temperature, cmd_path, airco, 'set_target_temp', temperature, info_color))
-
-          print ('%s--Fan | color=%s' % (prefix, color))
-          print ('%s----Rate | color=%s' % (prefix, color))
-          frates = OrderedDict([ ('auto','A'), ('silent','B'), ('1','3'), ('2','4'), ('3','5'), ('4','6'), ('5','7') ])
-          for frate in frates.keys():
-             if (frates[str(frate)] == airco_frate):
-                print (u'%s------%s | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, frate, cmd_path, airco, 'set_frate', frates[str(frate)], color))
-                print (u'%s------%s | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, frate, cmd_path, airco, 'set_frate', frates[str(frate)], color))
-             else:
-                print (u'%s------%s | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, frate, cmd_path, airco, 'set_frate', frates[str(frate)], info_color))
-                print (u'%s------%s | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, frate, cmd_path, airco, 'set_frate', frates[str(frate)], info_color))
-          print ('%s----Direction | color=%s' % (prefix, color))
-          fdirs = OrderedDict([ ('none','0'), ('vertical','1'), ('horizontal','2'), ('3D','3') ])
-          for fdir in fdirs.keys():
-             if (fdirs[str(fdir)] == airco_fdir):
-                print (u'%s------%s | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, fdir, cmd_path, airco, 'set_fdir', fdirs[str(fdir)], color))
-                print (u'%s------%s | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, fdir, cmd_path, airco, 'set_fdir', fdirs[str(fdir)], color))
-             else:
-                print (u'%s------%s | refresh=true terminal=false shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, fdir, cmd_path, airco, 'set_fdir', fdirs[str(fdir)], info_color))
-                print (u'%s------%s | refresh=true alternate=true terminal=true shell="%s" param1=%s param2=%s param3=%s color=%s' % (prefix, fdir, cmd_path, airco, 'set_fdir', fdirs[str(fdir)], info_color))
-
-
-
-    except Exception as e:
-       #print (e)
-       print ('%sNo Daikin airco detected | color=%s' % (prefix, color))
+    profile = (len(argv) == 2) and (argv[1] == '--profile')
 
+    response = None if profile else daemon_request({'op': 'menu', 'color': color, 'info_color': info_color})
+    if response is not None:
+       output = response['menu']
+    else:
+       renderer = MenuRenderer(color, info_color)
+       try:
+          with metrics.timer('mydaikin_refresh_seconds'):
+             aircos, snapshots = shared_fleet(reuse=0 if profile else None)
+          with metrics.timer('mydaikin_render_seconds'):
+             output = renderer.render(aircos, snapshots)
+       except Exception as e:
+          #print (e)
+          output = renderer.render_error()
+       if profile:
+          output = metrics.profile()
+       if MY_METRICS_EXPORT:
+          metrics.export()
+
+    sys.stdout.write(output)
+    sys.stdout.flush()
+
+
+STARTUP_TIMES.append(('definitions', time.perf_counter()))
 
 if __name__ == '__main__':
     main(sys.argv)
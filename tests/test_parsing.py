@@ -0,0 +1,128 @@
+'''Decoding of unit responses: Record.parse, parse_raw, parse_responses and process_response
+
+Run with `python -m pytest tests` or `python -m unittest discover tests`.
+'''
+
+import importlib.machinery
+import importlib.util
+import os
+import tempfile
+import unittest
+
+PLUGIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mydaikin.15m.py')
+
+
+def load_plugin():
+    os.environ.setdefault('MYDAIKIN_CACHE_DIR', tempfile.mkdtemp())
+    loader = importlib.machinery.SourceFileLoader('mydaikin', PLUGIN)
+    spec = importlib.util.spec_from_loader('mydaikin', loader)
+    plugin = importlib.util.module_from_spec(spec)
+    loader.exec_module(plugin)
+    return plugin
+
+
+plugin = load_plugin()
+
+BASIC_INFO = (b'ret=OK,type=aircon,reg=eu,dst=1,ver=1_2_51,rev=D3A0=C9F,pow=1,err=0,location=0,'
+              b'name=%4c%69%76%69%6e%67,icon=0,method=home only,port=30050,id=user=1,pw=,'
+              b'mac=0012A1B20000,adp_mode=run,')
+SENSOR_INFO = b'ret=OK,htemp=-,hhum=--,otemp=M,err=0,cmpfreq=38'
+CONTROL_INFO = (b'ret=OK,pow=0,mode=4,adv=,stemp=M,shum=--,dt1=25.0,dt2=M,f_rate=A,f_dir=3,'
+                b'alert=255,b_mode=4,b_stemp=21.5,b_shum=-')
+PARAM_NG = b'ret=PARAM NG'
+ADV_NG = b'ret=ADV_NG,adv='
+
+
+class ValuesTest(unittest.TestCase):
+
+    def test_values_with_equal_signs(self):
+        record = plugin.BasicInfo.parse(BASIC_INFO)
+        self.assertEqual(record.rev, 'D3A0=C9F')
+        self.assertEqual(record.name, 'Living')
+        self.assertEqual(record['mac'], '0012A1B20000')
+
+        record, raw = plugin.BasicInfo.parse_raw(BASIC_INFO)
+        self.assertEqual(record.rev, 'D3A0=C9F')
+        self.assertEqual(raw['id'], 'user=1')
+        self.assertEqual(raw['pw'], '')
+        self.assertNotIn('', raw)
+
+        info = plugin.process_response(BASIC_INFO)
+        self.assertEqual(info['rev'], 'D3A0=C9F')
+        self.assertEqual(info['id'], 'user=1')
+        self.assertNotIn('', info)
+
+    def test_temperatures_without_reading(self):
+        record = plugin.SensorInfo.parse(SENSOR_INFO)
+        self.assertIsNone(record.htemp)
+        self.assertIsNone(record.hhum)
+        self.assertEqual(record.otemp, 'M')
+        self.assertEqual(record.cmpfreq, 38)
+
+        record = plugin.ControlInfo.parse(CONTROL_INFO)
+        self.assertIs(record.pow, False)
+        self.assertEqual(record.mode, 4)
+        self.assertEqual(record.stemp, 'M')
+        self.assertIsNone(record.shum)
+        self.assertEqual(record.b_stemp, 21.5)
+        self.assertIsNone(record.b_shum)
+        self.assertEqual(record.get('shum', 'none'), 'none')
+
+    def test_raw_values_are_kept_as_sent(self):
+        record, raw = plugin.ControlInfo.parse_raw(CONTROL_INFO)
+        self.assertEqual(record, plugin.ControlInfo.parse(CONTROL_INFO))
+        self.assertEqual(raw['stemp'], 'M')
+        self.assertEqual(raw['shum'], '--')
+        self.assertEqual(raw['dt2'], 'M')
+        self.assertEqual(raw['adv'], '')
+        self.assertEqual(plugin.ControlInfo.from_raw(raw), record)
+
+        info = plugin.process_response(SENSOR_INFO)
+        self.assertEqual(info, {'htemp': '-', 'hhum': '--', 'otemp': 'M', 'err': '0', 'cmpfreq': '38'})
+
+    def test_parse_responses(self):
+        records = plugin.parse_responses(plugin.SensorInfo, [SENSOR_INFO, SENSOR_INFO.replace(b'htemp=-', b'htemp=21.5')])
+        self.assertEqual([record.htemp for record in records], [None, 21.5])
+
+
+class ExceptionsTest(unittest.TestCase):
+
+    PARSERS = [('parse', lambda response: plugin.ControlInfo.parse(response)),
+               ('parse_raw', lambda response: plugin.ControlInfo.parse_raw(response)),
+               ('parse_responses', lambda response: plugin.parse_responses(plugin.ControlInfo, [response])),
+               ('process_response', plugin.process_response)]
+
+    def test_param_ng(self):
+        for name, parse in self.PARSERS:
+            with self.subTest(name):
+                with self.assertRaises(plugin.ParamNGException):
+                    parse(PARAM_NG)
+
+    def test_adv_ng(self):
+        for name, parse in self.PARSERS:
+            with self.subTest(name):
+                with self.assertRaises(plugin.AdvNGException) as context:
+                    parse(ADV_NG)
+                self.assertNotIsInstance(context.exception, plugin.ParamNGException)
+
+    def test_unrecognized_responses(self):
+        for name, parse in self.PARSERS:
+            for response in [b'ret=NG', b'<html>', b'']:
+                with self.subTest(name, response=response):
+                    with self.assertRaises(plugin.RespException) as context:
+                        parse(response)
+                    self.assertNotIsInstance(context.exception, (plugin.ParamNGException, plugin.AdvNGException))
+
+    def test_parse_responses_not_strict(self):
+        records = plugin.parse_responses(plugin.ControlInfo, [CONTROL_INFO, PARAM_NG, ADV_NG], strict=False)
+        self.assertIsInstance(records[0], plugin.ControlInfo)
+        self.assertIsInstance(records[1], plugin.ParamNGException)
+        self.assertIsInstance(records[2], plugin.AdvNGException)
+
+    def test_command_errors(self):
+        self.assertEqual(plugin.command_error(plugin.ParamNGException('Wrong parameters')), 'PARAM NG')
+        self.assertEqual(plugin.command_error(plugin.AdvNGException('Wrong ADV')), 'ADV_NG')
+
+
+if __name__ == '__main__':
+    unittest.main()
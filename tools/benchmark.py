@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Offline benchmarks for mydaikin.15m.py
+#
+# Runs the plugin against the adapter simulator and measures the refresh, command,
+# discovery and parsing hot paths, and the fixed startup cost of the plugin process.
+# Results are written as JSON, so that runs of different versions can be compared.
+#
+# Usage: python3 tools/benchmark.py --output results.json
+#
+# The simulated units listen on port 80 of 127.0.0.2 onwards, see tools/simulator.py.
+
+import argparse
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+import simulator
+
+
+PLUGIN = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'mydaikin.15m.py')
+
+SUBNET = '127.0.0.0/24'
+
+
+def load_plugin(cache_dir):
+    '''Import the plugin, keeping its caches in `cache_dir`'''
+    os.environ['MYDAIKIN_CACHE_DIR'] = cache_dir
+    loader = importlib.machinery.SourceFileLoader('mydaikin', PLUGIN)
+    spec = importlib.util.spec_from_loader('mydaikin', loader)
+    plugin = importlib.util.module_from_spec(spec)
+    loader.exec_module(plugin)
+    # Reach the simulated units, which do not receive broadcasts on loopback
+    plugin.MY_DISCOVERY_SUBNETS = [SUBNET]
+    # Measure every command on its own rather than coalesced with the previous one
+    plugin.MY_COMMAND_DEBOUNCE = 0
+    # and every refresh on its own rather than reusing the result of the previous one
+    plugin.MY_REFRESH_REUSE = 0
+    return plugin
+
+
+def plugin_version():
+    with open(PLUGIN) as f:
+        match = re.search(r'<xbar.version>(.*)</xbar.version>', f.read())
+    return match.group(1) if match else None
+
+
+def clear_cache(cache_dir):
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {'n': len(samples),
+            'min': samples[0],
+            'median': statistics.median(samples),
+            'p95': samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+            'max': samples[-1]}
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def render(plugin):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        plugin.main(['mydaikin.15m.py'])
+    return out.getvalue()
+
+
+def bench_refresh(plugin, cache_dir, units, repeat, latency):
+    '''Full menu refresh, with an empty cache and with a warm cache'''
+    results = {}
+    with simulator.Simulator(units=units, latency=latency) as sim:
+        for name, warm in [('cold', False), ('warm', True)]:
+            times, requests = [], []
+            for i in range(0, repeat):
+                if warm:
+                    render(plugin)
+                else:
+                    clear_cache(cache_dir)
+                before = sim.requests
+                elapsed, output = timed(render, plugin)
+                if 'No Daikin airco detected' in output:
+                    raise RuntimeError('refresh of {} units found no units'.format(units))
+                times.append(elapsed)
+                requests.append(sim.requests - before)
+            results[name] = {'seconds': summarize(times), 'requests': summarize(requests)}
+    return results
+
+
+def bench_commands(plugin, cache_dir, repeat, latency):
+    '''Latency of every set_* command, with and without a recently cached control state'''
+    commands = [('set_power', '1'), ('set_target_temp', '22.0'), ('set_mode', '4'),
+                ('set_frate', 'A'), ('set_fdir', '0'), ('set_batch', 'mode=4,stemp=21.0,f_rate=A')]
+    results = {}
+    with simulator.Simulator(units=1, latency=latency) as sim:
+        host = sim.hosts[0]
+        for command, value in commands:
+            results[command] = {}
+            for name, warm in [('read_modify_write', False), ('cached_state', True)]:
+                times, requests = [], []
+                for i in range(0, repeat):
+                    clear_cache(cache_dir)
+                    if warm:
+                        plugin.run_command(host, command, value)
+                    before = sim.requests
+                    elapsed, state = timed(plugin.run_command, host, command, value)
+                    times.append(elapsed)
+                    requests.append(sim.requests - before)
+                results[command][name] = {'seconds': summarize(times), 'requests': summarize(requests)}
+    return results
+
+
+def bench_discovery(plugin, units, repeat, latencies):
+    '''Discovery time for units responding after a given delay'''
+    results = {}
+    for latency in latencies:
+        with simulator.Simulator(units=units, latency=latency) as sim:
+            times, found = [], []
+            for i in range(0, repeat):
+                elapsed, discovered = timed(plugin.discover, waitfor=None, probe_address=[], subnets=[SUBNET])
+                times.append(elapsed)
+                found.append(len(discovered))
+            results[str(latency)] = {'seconds': summarize(times), 'units': summarize(found)}
+    return results
+
+
+def bench_parsing(plugin, count):
+    '''Throughput of response parsing on bulk payloads
+
+       Measures decoding into a dictionary and parsing that, and, for
+       versions that have it, the single pass batch parser.
+    '''
+    unit = simulator.SimulatedUnit(0, '127.0.0.2')
+    payloads = {'basic_info': (unit.basic_info().encode(), plugin.parse_basic_info, 'BasicInfo'),
+                'sensor_info': (unit.sensor_info().encode(), plugin.parse_sensor_info, 'SensorInfo'),
+                'control_info': (unit.control_info().encode(), plugin.parse_control_info, 'ControlInfo')}
+    results = {}
+    for name, (payload, parse, record) in payloads.items():
+        batch = [payload] * count
+        elapsed, parsed = timed(lambda: [parse(plugin.process_response(p)) for p in batch])
+        results[name] = {'responses': count, 'seconds': elapsed, 'per_second': count / elapsed}
+        if hasattr(plugin, 'parse_responses'):
+            elapsed, parsed = timed(plugin.parse_responses, getattr(plugin, record), batch)
+            results[name + '_batch'] = {'responses': count, 'seconds': elapsed, 'per_second': count / elapsed}
+    return results
+
+
+def bench_startup(cache_dir, repeat):
+    '''Wall time of a plugin process that does no network I/O, i.e. its fixed cost per invocation'''
+    env = dict(os.environ, MYDAIKIN_CACHE_DIR=cache_dir)
+    times = []
+    for i in range(0, repeat):
+        elapsed, result = timed(subprocess.run, [sys.executable, PLUGIN, '127.0.0.1', 'unknown_command', '0'],
+                                stdout=subprocess.DEVNULL, env=env)
+        times.append(elapsed)
+    return {'seconds': summarize(times)}
+
+
+def bench_render(plugin, units, repeat):
+    '''Menu rendering time from snapshots, first render and unchanged units'''
+    if not hasattr(plugin, 'MenuRenderer'):
+        return None
+    aircos, snapshots = {}, plugin.OrderedDict()
+    for i in range(0, units):
+        unit = simulator.SimulatedUnit(i, '127.0.0.{}'.format(i + 2))
+        snapshot = plugin.UnitSnapshot(unit.host,
+                                       plugin.BasicInfo.parse(unit.basic_info().encode()),
+                                       plugin.ControlInfo.parse(unit.control_info().encode()),
+                                       plugin.SensorInfo.parse(unit.sensor_info().encode()))
+        aircos[unit.host] = {'mac': unit.mac, 'name': unit.name}
+        snapshots[unit.host] = plugin.Aircon.from_snapshot(snapshot)
+    first, cached = [], []
+    for i in range(0, repeat):
+        renderer = plugin.MenuRenderer('#00000E', '#616161')
+        first.append(timed(renderer.render, aircos, snapshots)[0])
+        cached.append(timed(renderer.render, aircos, snapshots)[0])
+    return {'first': summarize(first), 'cached': summarize(cached)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark mydaikin.15m.py against simulated units')
+    parser.add_argument('--units', default='1,4,16,64', help='comma separated fleet sizes for the refresh benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of every measurement')
+    parser.add_argument('--latency', type=float, default=0.02, help='response latency of the simulated units')
+    parser.add_argument('--discovery-latencies', default='0,0.1,0.5', help='comma separated response delays for discovery')
+    parser.add_argument('--parse-count', type=int, default=20000, help='responses parsed per payload type')
+    parser.add_argument('--only', default='refresh,commands,discovery,parsing,render,startup', help='benchmarks to run')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv[1:])
+
+    only = args.only.split(',')
+    cache_dir = tempfile.mkdtemp(prefix='mydaikin-bench-')
+    results = {'version': plugin_version(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'time': time.time(),
+               'settings': vars(args)}
+    try:
+        plugin = load_plugin(cache_dir)
+        if 'refresh' in only:
+            results['refresh'] = {str(units): bench_refresh(plugin, cache_dir, units, args.repeat, args.latency)
+                                  for units in [int(u) for u in args.units.split(',')]}
+        if 'commands' in only:
+            results['commands'] = bench_commands(plugin, cache_dir, args.repeat, args.latency)
+        if 'discovery' in only:
+            results['discovery'] = bench_discovery(plugin, 4, args.repeat,
+                                                   [float(l) for l in args.discovery_latencies.split(',')])
+        if 'parsing' in only:
+            results['parsing'] = bench_parsing(plugin, args.parse_count)
+        if 'startup' in only:
+            results['startup'] = bench_startup(cache_dir, args.repeat)
+        if 'render' in only:
+            results['render'] = {str(units): bench_render(plugin, units, args.repeat)
+                                 for units in [int(u) for u in args.units.split(',')]}
+    finally:
+        shutil.rmtree(cache_dir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Daikin adapter simulator
+#
+# Spins up N fake Daikin wifi adapters on loopback addresses, answering both the
+# UDP discovery probe and the HTTP API used by mydaikin.15m.py, so that the plugin
+# can be developed and benchmarked without any hardware.
+#
+# Usage: python3 tools/simulator.py --units 10 --latency 0.05 --loss 0.01
+#
+# Every unit listens on its own address, starting at --base-address. On Linux the
+# whole 127.0.0.0/8 network is available. On Mac OS X add aliases first, e.g.
+#   sudo ifconfig lo0 alias 127.0.0.2 up
+
+import argparse
+import calendar
+import ipaddress
+import random
+import selectors
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl, quote
+
+
+DSCV_TXT = b"DAIKIN_UDP/common/basic_info"
+DSCV_PRT = 30050
+
+NAMES = ['Living', 'Kitchen', 'Bedroom', 'Office', 'Attic', 'Hall', 'Study', 'Guest']
+
+MODES = ['0', '1', '2', '3', '4', '6', '7']
+FRATES = ['A', 'B', '3', '4', '5', '6', '7']
+FDIRS = ['0', '1', '2', '3']
+# Setpoint range of auto, cooling and heating mode
+SETPOINTS = {'0': (18.0, 30.0), '1': (18.0, 30.0), '3': (18.0, 32.0), '4': (10.0, 30.0), '7': (18.0, 30.0)}
+
+
+class SimulatedUnit():
+    '''State and API responses of a single fake adapter'''
+
+    def __init__(self, index, address, port=80, latency=0.0, jitter=0.0, loss=0.0, param_ng=0.0,
+                 max_connections=2, seed=None):
+        self.index = index
+        self.address = address
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.param_ng = param_ng
+        self.max_connections = max_connections
+        self.random = random.Random(seed if seed is not None else index)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.refused = 0
+
+        self.mac = '0012A1B2{:04X}'.format(index)
+        self.name = '{} {}'.format(NAMES[index % len(NAMES)], index // len(NAMES) + 1)
+        self.control = {'pow': '1' if index % 2 == 0 else '0',
+                        'mode': '4' if index % 3 else '3',
+                        'stemp': '21.0',
+                        'shum': '0',
+                        'f_rate': 'A',
+                        'f_dir': '0'}
+        # Every fourth unit only swings vertically
+        self.fdirs = FDIRS if index % 4 != 3 else ['0', '1']
+        self.htemp = 18.0 + (index % 7)
+        self.otemp = 7.0
+
+    @property
+    def host(self):
+        return self.address if self.port == 80 else '{}:{}'.format(self.address, self.port)
+
+    def delay(self):
+        if self.latency > 0 or self.jitter > 0:
+            time.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+
+    def dropped(self):
+        return self.random.random() < self.loss
+
+    def basic_info(self):
+        return ('ret=OK,type=aircon,reg=eu,dst=1,ver=1_2_51,rev=D3A0C9F,pow={},err=0,location=0,'
+                'name={},icon=0,method=home only,port=30050,id=,pw=,lpw_flag=0,adp_kind=3,pv=2,'
+                'cpv=2,cpv_minor=00,led=1,en_setzone=1,mac={},adp_mode=run,en_hol=0,grp_name=,'
+                'en_grp=0').format(self.control['pow'], quote(self.name, safe=''), self.mac)
+
+    def sensor_info(self):
+        # Drift the indoor temperature towards the target while running
+        with self.lock:
+            try:
+                target = float(self.control['stemp'])
+            except ValueError:
+                target = self.htemp
+            if self.control['pow'] == '1':
+                self.htemp += max(-0.5, min(0.5, target - self.htemp))
+            return 'ret=OK,htemp={:.1f},hhum=-,otemp={:.1f},err=0,cmpfreq={}'.format(
+                self.htemp, self.otemp, 38 if self.control['pow'] == '1' else 0)
+
+    def control_info(self):
+        with self.lock:
+            c = dict(self.control)
+        return ('ret=OK,pow={pow},mode={mode},adv=,stemp={stemp},shum={shum},dt1=25.0,dt2=M,dt3=25.0,'
+                'dt4=21.0,dt5=21.0,dt7=25.0,dh1=AUTO,dh2=50,dh3=0,dh4=0,dh5=0,dh7=AUTO,dhh=50,'
+                'b_mode={mode},b_stemp={stemp},b_shum={shum},alert=255,f_rate={f_rate},f_dir={f_dir},'
+                'b_f_rate={f_rate},b_f_dir={f_dir},dfr1=A,dfr2=A,dfr3=A,dfr4=A,dfr5=A,dfr6=A,dfr7=A,'
+                'dfrh=A,dfd1=0,dfd2=0,dfd3=0,dfd4=0,dfd5=0,dfd6=0,dfd7=0,dfdh=0').format(**c)
+
+    def model_info(self):
+        return ('ret=OK,model=0AB9,type=N,pv=2,cpv=2,cpv_minor=00,mid=NA,humd=0,s_humd=0,acled=0,land=0,'
+                'elec=1,temp=1,temp_rng=0,m_dtct=1,ac_dst=--,disp_dry=0,dmnd=0,en_scdltmr=1,en_frate=1,'
+                'en_fdir=1,s_fdir={},en_rtemp_a=0,en_spmode=0,en_ipw_sep=0,en_mompow=0').format(3 if len(self.fdirs) == 4 else 1)
+
+    def energy(self):
+        # Consumption per hour in units of 0.1 kWh, and the hourly counters of today
+        rate = self.index % 3 + 1
+        hour = time.localtime().tm_hour
+        return rate, [rate if h <= hour else 0 for h in range(0, 24)]
+
+    def day_power(self):
+        rate, today = self.energy()
+        return 'ret=OK,curr_day_heat={},prev_1day_heat={},curr_day_cool={},prev_1day_cool={}'.format(
+            '/'.join(str(c) for c in today), '/'.join([str(rate)] * 24), '/'.join(['0'] * 24), '/'.join(['0'] * 24))
+
+    def week_power(self):
+        rate, today = self.energy()
+        days = [sum(today)] + [24 * rate] * 13
+        return 'ret=OK,s_dayw={},week_heat={},week_cool={}'.format(
+            (time.localtime().tm_wday + 1) % 7, '/'.join(str(c) for c in days), '/'.join(['0'] * 14))
+
+    def year_power(self):
+        rate, today = self.energy()
+        now = time.localtime()
+        previous = [calendar.monthrange(now.tm_year - 1, m)[1] * 24 * rate for m in range(1, 13)]
+        current = [calendar.monthrange(now.tm_year, m)[1] * 24 * rate if m < now.tm_mon else 0 for m in range(1, 13)]
+        current[now.tm_mon - 1] = (now.tm_mday - 1) * 24 * rate + sum(today)
+        return 'ret=OK,curr_year_heat={},prev_year_heat={},curr_year_cool={},prev_year_cool={}'.format(
+            '/'.join(str(c) for c in current), '/'.join(str(c) for c in previous), '/'.join(['0'] * 12), '/'.join(['0'] * 12))
+
+    def set_control_info(self, params):
+        # Like the real adapters, all of pow, mode, stemp, shum, f_rate and f_dir are required
+        for field in ['pow', 'mode', 'stemp', 'shum', 'f_rate', 'f_dir']:
+            if field not in params:
+                return 'ret=PARAM NG'
+        if (params['pow'] not in ['0', '1'] or params['mode'] not in MODES or
+            params['f_rate'] not in FRATES or params['f_dir'] not in self.fdirs):
+            return 'ret=PARAM NG'
+        if params['stemp'] not in ['M', '--']:
+            try:
+                stemp = float(params['stemp'])
+            except ValueError:
+                return 'ret=PARAM NG'
+            low, high = SETPOINTS.get(params['mode'], (10.0, 32.0))
+            if not low <= stemp <= high:
+                return 'ret=PARAM NG'
+        with self.lock:
+            self.control.update({k: params[k] for k in self.control})
+        return 'ret=OK,adv='
+
+    def respond(self, path, params):
+        '''Response body for an API request, or None to drop the connection'''
+        with self.lock:
+            self.requests += 1
+        self.delay()
+        if self.dropped():
+            return None
+        if self.random.random() < self.param_ng:
+            return 'ret=PARAM NG'
+        if path == '/common/basic_info':
+            return self.basic_info()
+        elif path == '/aircon/get_sensor_info':
+            return self.sensor_info()
+        elif path == '/aircon/get_control_info':
+            return self.control_info()
+        elif path == '/aircon/set_control_info':
+            return self.set_control_info(params)
+        elif path == '/aircon/get_model_info':
+            return self.model_info()
+        elif path == '/aircon/get_day_power_ex':
+            return self.day_power()
+        elif path == '/aircon/get_week_power_ex':
+            return self.week_power()
+        elif path == '/aircon/get_year_power_ex':
+            return self.year_power()
+        elif path == '/common/reboot':
+            return 'ret=OK'
+        return 'ret=PARAM NG'
+
+
+class UnitRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        body = self.server.unit.respond(url.path, dict(parse_qsl(url.query, keep_blank_values=True)))
+        if body is None:
+            self.close_connection = True
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class UnitHTTPServer(socketserver.ThreadingTCPServer):
+    '''HTTP server of a unit, refusing connections above its limit'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, unit):
+        self.unit = unit
+        self.requests = set()
+        socketserver.ThreadingTCPServer.__init__(self, (unit.address, unit.port), UnitRequestHandler)
+
+    def verify_request(self, request, client_address):
+        with self.unit.lock:
+            if self.unit.max_connections and self.unit.connections >= self.unit.max_connections:
+                self.unit.refused += 1
+                return False
+            self.unit.connections += 1
+            self.requests.add(request)
+        return True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingTCPServer.process_request_thread(self, request, client_address)
+        finally:
+            with self.unit.lock:
+                self.unit.connections -= 1
+                self.requests.discard(request)
+
+    def server_close(self):
+        socketserver.ThreadingTCPServer.server_close(self)
+        # Also drop kept alive connections, like a unit that is switched off
+        with self.unit.lock:
+            for request in list(self.requests):
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class Simulator():
+    '''A fleet of simulated units
+
+       Units are numbered from `base_address` onwards. Discovery probes
+       are answered from every unit's own address by a single thread.
+    '''
+
+    def __init__(self, units=1, base_address='127.0.0.2', port=80, discovery_port=DSCV_PRT, **unit_kw):
+        first = ipaddress.IPv4Address(base_address)
+        self.units = [SimulatedUnit(i, str(first + i), port, **unit_kw) for i in range(0, units)]
+        self.discovery_port = discovery_port
+        self.servers = []
+        self.sockets = []
+        self.selector = None
+        self.running = False
+
+    @property
+    def hosts(self):
+        return [unit.host for unit in self.units]
+
+    @property
+    def requests(self):
+        return sum(unit.requests for unit in self.units)
+
+    def start(self):
+        self.running = True
+        self.selector = selectors.DefaultSelector()
+        for unit in self.units:
+            server = UnitHTTPServer(unit)
+            if unit.port == 0:
+                unit.port = server.server_address[1]
+            thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1})
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+
+            sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sckt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sckt.bind((unit.address, self.discovery_port))
+            sckt.setblocking(False)
+            self.selector.register(sckt, selectors.EVENT_READ, unit)
+            self.sockets.append(sckt)
+
+        thread = threading.Thread(target=self.answer_probes)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def answer_probes(self):
+        while self.running:
+            for key, events in self.selector.select(timeout=0.1):
+                unit = key.data
+                try:
+                    data, addr = key.fileobj.recvfrom(1024)
+                except OSError:
+                    continue
+                if data != DSCV_TXT or unit.dropped():
+                    continue
+                threading.Timer(max(0.0, unit.random.gauss(unit.latency, unit.jitter)),
+                                self.answer_probe, (key.fileobj, unit, addr)).start()
+
+    def answer_probe(self, sckt, unit, addr):
+        try:
+            sckt.sendto(unit.basic_info().encode(), addr)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.running = False
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for sckt in self.sockets:
+            self.selector.unregister(sckt)
+            sckt.close()
+        self.selector.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Simulate Daikin wifi adapters on loopback addresses')
+    parser.add_argument('--units', type=int, default=4, help='number of units')
+    parser.add_argument('--base-address', default='127.0.0.2', help='address of the first unit')
+    parser.add_argument('--port', type=int, default=80, help='HTTP port of every unit')
+    parser.add_argument('--discovery-port', type=int, default=DSCV_PRT, help='UDP discovery port')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability of dropping a response')
+    parser.add_argument('--param-ng', type=float, default=0.0, help='probability of answering PARAM NG')
+    parser.add_argument('--max-connections', type=int, default=2, help='concurrent connections per unit, 0 for no limit')
+    args = parser.parse_args(argv[1:])
+
+    simulator = Simulator(units=args.units,
+                          base_address=args.base_address,
+                          port=args.port,
+                          discovery_port=args.discovery_port,
+                          latency=args.latency,
+                          jitter=args.jitter,
+                          loss=args.loss,
+                          param_ng=args.param_ng,
+                          max_connections=args.max_connections)
+    simulator.start()
+    for unit in simulator.units:
+        print('{}\t{}\t{}'.format(unit.host, unit.mac, unit.name))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv)